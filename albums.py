@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import asyncio
+import logging
+
+
+class AlbumBuffer:
+    # Telegram delivers an album as one NewMessage per photo, all sharing a grouped_id. The parts are held until
+    # window seconds pass without another one (or max_size arrive), then the handler runs once, for the part with
+    # the caption, and members() hands every part to the mixins so the whole album gets one reply
+
+    def __init__(self, window: float = 1.0, max_size: int = 10, remember: int = 256):
+        self.window = window
+        self.max_size = max_size
+        self.remember = remember
+        # (chat_id, grouped_id) -> events of an album still arriving
+        self.pending : dict = {}
+        self.timers : dict = {}
+        # (chat_id, grouped_id) -> messages of the albums handled last, oldest first
+        self.albums : OrderedDict = OrderedDict()
+        # Strong references to the flushes, the event loop only keeps weak ones
+        self.tasks : set = set()
+        self.handled = 0
+        self.merged = 0
+        self.late = 0
+
+    async def dispatch(self, event, handler):
+        grouped_id = event.message.grouped_id
+        if grouped_id is None:
+            await handler(event)
+            return
+        key = (event.chat_id, grouped_id)
+        if key in self.albums:
+            # The album was answered without this part, it doesn't get a reply of its own
+            self.late += 1
+            return
+        parts : list = self.pending.setdefault(key, [])
+        parts.append(event)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if len(parts) >= self.max_size:
+            await self.flush(key, handler)
+            return
+        self.timers[key] = asyncio.get_running_loop().call_later(self.window, self.flushLater, key, handler)
+
+    def flushLater(self, key: tuple, handler):
+        task = asyncio.ensure_future(self.flush(key, handler))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, key: tuple, handler):
+        self.timers.pop(key, None)
+        parts : list = sorted(self.pending.pop(key), key=lambda event: event.message.id)
+        # Only one part carries the caption, usually the first
+        lead = next((event for event in parts if event.message.message), parts[0])
+        self.albums[key] = [event.message for event in parts]
+        while len(self.albums) > self.remember:
+            self.albums.popitem(last=False)
+        self.handled += 1
+        self.merged += len(parts)-1
+        logging.info(f'Album {key[1]} in chat {key[0]}: {len(parts)} parts, replying to message {lead.message.id}')
+        try:
+            await handler(lead)
+        except Exception:
+            logging.exception(f'Failed to handle album {key[1]} in chat {key[0]}')
+
+    def members(self, message) -> list:
+        # Every part of the message's album, or just the message
+        if message.grouped_id is None:
+            return [message]
+        return self.albums.get((message.chat_id, message.grouped_id), [message])
+
+    def stats(self) -> dict:
+        return {
+            'albums': self.handled,
+            'merged': self.merged,
+            'late': self.late,
+            'pending': len(self.pending)
+        }
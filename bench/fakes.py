@@ -0,0 +1,157 @@
+from collections import Counter
+from datetime import datetime, timezone
+from io import BytesIO
+from PIL import Image
+from telethon import types, utils
+from types import SimpleNamespace
+import asyncio
+import itertools
+import time
+
+
+def syntheticJpeg(width: int = 1280, height: int = 960) -> bytes:
+    image = Image.new('RGB', (width, height))
+    for x in range(0, width, 64):
+        for y in range(0, height, 64):
+            image.paste(((x*7) % 256, (y*5) % 256, (x+y) % 256), (x, y, x+64, y+64))
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+class FakeMessage:
+    # The subset of telethon's Message the handler touches
+
+    def __init__(self, client: 'FakeTelegramClient', peer_id, id: int, sender_id: int, text: str, reply_to=None, fwd_from=None, forward=None, media=None, grouped_id=None):
+        self.client = client
+        self.peer_id = peer_id
+        self.id = id
+        self.sender_id = sender_id
+        self.message = text
+        self.reply_to = reply_to
+        self.fwd_from = fwd_from
+        self.forward = forward
+        self.media = media
+        self.grouped_id = grouped_id
+        self.date = datetime.now(timezone.utc)
+
+    @property
+    def chat_id(self):
+        return utils.get_peer_id(self.peer_id)
+
+    @property
+    def web_preview(self):
+        return self.media.webpage if isinstance(self.media, types.MessageMediaWebPage) else None
+
+    async def reply(self, text: str):
+        return await self.client.sendMessage(self.peer_id, text, self.id)
+
+    async def edit(self, text: str):
+        # Like telethon, the edited message comes back as a new object and this one keeps its old text
+        await self.client.rpc('edit_message')
+        edited = FakeMessage(self.client, self.peer_id, self.id, self.sender_id, text, self.reply_to, self.fwd_from, self.forward, self.media, self.grouped_id)
+        edited.date = self.date
+        return self.client.addMessage(edited)
+
+
+class FakeEvent:
+    # The subset of events.NewMessage.Event the handler touches
+
+    def __init__(self, message: FakeMessage, sender, pts: int):
+        self.message = message
+        self.sender = sender
+        self.original_update = SimpleNamespace(pts=pts)
+
+    @property
+    def raw_text(self) -> str:
+        return self.message.message
+
+    @property
+    def sender_id(self):
+        return self.message.sender_id
+
+    @property
+    def chat_id(self):
+        return self.message.chat_id
+
+    async def get_sender(self):
+        await self.message.client.rpc('get_sender')
+        return self.sender
+
+    async def reply(self, text: str):
+        return await self.message.reply(text)
+
+
+class FakeTelegramClient:
+    # In-process stand-in for TelegramClient: entities and messages live in dicts and every call sleeps
+    # for `latency` seconds to model the RPC round trip
+
+    def __init__(self, me: types.User, latency: float = 0.02):
+        self.me = me
+        self.latency = latency
+        self.entities : dict = {utils.get_peer_id(me): me}
+        self.messages : dict = {}
+        self.message_ids = itertools.count(1_000_000)
+        self.photo_ids = itertools.count(1)
+        self.photo_bytes = syntheticJpeg()
+        self.calls : Counter = Counter()
+        # (chat_id, replied to message id) -> (time the bot replied, reply message id)
+        self.replies : dict = {}
+
+    async def rpc(self, name: str):
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+
+    def addEntity(self, entity):
+        self.entities[utils.get_peer_id(entity)] = entity
+        return entity
+
+    def user(self, id: int, first_name: str, last_name: str = None, username: str = None) -> types.User:
+        return self.addEntity(types.User(id=id, first_name=first_name, last_name=last_name, username=username, access_hash=id))
+
+    def group(self, id: int, title: str) -> types.Channel:
+        return self.addEntity(types.Channel(id=id, title=title, photo=types.ChatPhotoEmpty(), date=datetime.now(timezone.utc), megagroup=True, access_hash=id))
+
+    def photo(self, photo_id: int = None) -> types.Photo:
+        photo_id = next(self.photo_ids) if photo_id is None else photo_id
+        return types.Photo(
+            id=photo_id,
+            access_hash=photo_id,
+            file_reference=b'',
+            date=datetime.now(timezone.utc),
+            sizes=[types.PhotoSize(type='m', w=320, h=240, size=20000), types.PhotoSize(type='y', w=1280, h=960, size=len(self.photo_bytes))],
+            dc_id=2
+        )
+
+    def addMessage(self, message: FakeMessage) -> FakeMessage:
+        self.messages[(utils.get_peer_id(message.peer_id, add_mark=False), message.id)] = message
+        return message
+
+    async def sendMessage(self, peer_id, text: str, reply_to: int) -> FakeMessage:
+        await self.rpc('send_message')
+        message = FakeMessage(
+            self, peer_id, next(self.message_ids), self.me.id, text,
+            reply_to=types.MessageReplyHeader(reply_to_msg_id=reply_to)
+        )
+        self.replies[(message.chat_id, reply_to)] = (time.perf_counter(), message.id)
+        return self.addMessage(message)
+
+    async def get_me(self):
+        await self.rpc('get_me')
+        return self.me
+
+    async def get_entity(self, peer):
+        await self.rpc('get_entity')
+        return self.entities[utils.get_peer_id(peer)]
+
+    async def get_messages(self, chat, ids: int):
+        await self.rpc('get_messages')
+        return self.messages.get((utils.get_peer_id(chat, add_mark=False) if not isinstance(chat, int) else chat, ids))
+
+    async def download_media(self, media, file, thumb=None):
+        await self.rpc('download_media')
+        file.write(self.photo_bytes)
+        return file
+
+    async def __call__(self, request):
+        await self.rpc(type(request).__name__)
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+REPLY_TEXT = 'That is a genuinely interesting point, although I would argue the opposite is just as likely to be true here'
+
+
+class FakeOpenAIServer:
+    # Minimal OpenAI compatible /v1/chat/completions endpoint on a local port. Answers after first_token_latency
+    # seconds and then sends one word every token_latency seconds, streamed as server-sent events when asked to
+
+    def __init__(self, first_token_latency: float = 0.3, token_latency: float = 0.02, reply_text: str = REPLY_TEXT):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.words = reply_text.split(' ')
+        self.ids = itertools.count(1)
+        self.requests = 0
+        self.streamed = 0
+        self.prompt_bytes = 0
+        self.server = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self.server = await asyncio.start_server(self.handle, host, port)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}/v1'
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if len(request_line) == 0:
+                    return
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if len(line) == 0:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if not request_line.split(b' ')[1].endswith(b'/chat/completions'):
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                    await writer.drain()
+                    continue
+                self.requests += 1
+                self.prompt_bytes += len(body)
+                request = json.loads(body)
+                if request.get('stream'):
+                    # No Content-Length, the response ends when the connection closes
+                    self.streamed += 1
+                    await self.stream(writer, request)
+                    return
+                await self.complete(writer, request, len(body))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logging.exception('Fake OpenAI server failed to handle a request')
+        finally:
+            writer.close()
+
+    def completionId(self) -> str:
+        return f'chatcmpl-bench{next(self.ids)}'
+
+    async def complete(self, writer: asyncio.StreamWriter, request: dict, prompt_bytes: int):
+        await asyncio.sleep(self.first_token_latency + self.token_latency*(len(self.words)-1))
+        body = json.dumps({
+            'id': self.completionId(),
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'bench'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': ' '.join(self.words)},
+                'finish_reason': 'stop'
+            }],
+            # Roughly 4 bytes per token is close enough for counters
+            'usage': {
+                'prompt_tokens': prompt_bytes//4,
+                'completion_tokens': len(self.words),
+                'total_tokens': prompt_bytes//4 + len(self.words)
+            }
+        }).encode('utf-8')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: '+str(len(body)).encode()+b'\r\n\r\n'+body)
+        await writer.drain()
+
+    async def stream(self, writer: asyncio.StreamWriter, request: dict):
+        completion_id = self.completionId()
+        created = int(time.time())
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+
+        def chunk(delta: dict, finish_reason=None) -> bytes:
+            return b'data: '+json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': request.get('model', 'bench'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+            }).encode('utf-8')+b'\n\n'
+
+        await asyncio.sleep(self.first_token_latency)
+        writer.write(chunk({'role': 'assistant', 'content': ''}))
+        for i, word in enumerate(self.words):
+            if i > 0:
+                await asyncio.sleep(self.token_latency)
+            writer.write(chunk({'content': word if i == 0 else ' '+word}))
+            await writer.drain()
+        writer.write(chunk({}, 'stop')+b'data: [DONE]\n\n')
+        await writer.drain()
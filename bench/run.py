@@ -0,0 +1,352 @@
+# Offline replay benchmark for the message handler, see the Benchmarks section of the README
+#   python -m bench.run [--scenario burst deep_thread] [--size 50] [--output results.json] [--compare previous.json]
+
+from datetime import datetime, timezone
+from metrics import Histogram
+from telethon import types, utils
+from types import SimpleNamespace
+from bench.fakes import FakeEvent, FakeMessage, FakeTelegramClient
+from bench.openai_stub import FakeOpenAIServer
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCENARIOS : dict = {}
+
+def scenario(name: str):
+    def register(function):
+        SCENARIOS[name] = function
+        return function
+    return register
+
+
+def percentiles(samples: list) -> dict:
+    histogram = Histogram(max(1, len(samples)))
+    for sample in samples:
+        histogram.observe(sample)
+    quantiles = histogram.quantiles()
+    return {'p50': quantiles[0.5], 'p95': quantiles[0.95], 'p99': quantiles[0.99], 'max': max(samples, default=0.0), 'count': len(samples)}
+
+
+class Bench:
+    # Builds synthetic NewMessage events, feeds them through PREFILTER and the handler the same way telethon would
+    # (one task per accepted update) and keeps the dispatch times to measure reply latency
+
+    def __init__(self, main, client: FakeTelegramClient):
+        self.main = main
+        self.client = client
+        self.message_ids = itertools.count(1)
+        self.pts = itertools.count(1)
+        self.entity_ids = itertools.count(10_000)
+        self.handlers : set = set()
+        self.dispatched : dict = {}
+        self.events = 0
+        self.users = [self.client.user(next(self.entity_ids), name, 'Benchmark', name.lower()) for name in ('Anna', 'Boris', 'Vera', 'Gleb', 'Dasha')]
+
+    def group(self, triggers: list = None) -> types.Channel:
+        chat = self.client.group(next(self.entity_ids), 'Bench group')
+        if triggers is not None:
+            self.main.TARGETED_INDIVIDUALS['CHATS'][str(chat.id)] = {'triggers': triggers}
+            self.main.POLICIES.invalidate(chat_id=chat.id)
+        return chat
+
+    def event(self, chat: types.Channel, sender: types.User, text: str, **kwargs) -> FakeEvent:
+        message = FakeMessage(self.client, types.PeerChannel(chat.id), next(self.message_ids), sender.id, text, **kwargs)
+        self.client.addMessage(message)
+        return FakeEvent(message, sender, next(self.pts))
+
+    def dispatch(self, event: FakeEvent):
+        self.events += 1
+        if not self.main.PREFILTER(event):
+            return
+        self.dispatched[(event.chat_id, event.message.id)] = time.perf_counter()
+        task = asyncio.ensure_future(self.main.fedorGPTEventHandler(event))
+        self.handlers.add(task)
+        task.add_done_callback(self.handlers.discard)
+
+    async def drain(self):
+        # Handlers, scheduler workers and background summaries can each start more of the others
+        while True:
+            pending = set(self.handlers) | set(self.main.BACKGROUND_TASKS)
+            for workers in self.main.SCHEDULER.tasks.values():
+                pending |= workers
+            pending |= set(self.main.ALBUMS.tasks)
+            pending = {task for task in pending if not task.done()}
+            if len(pending) == 0:
+                if len(self.main.ALBUMS.pending) == 0:
+                    return
+                # Albums still inside their buffering window
+                await asyncio.sleep(self.main.ALBUMS.window)
+                continue
+            await asyncio.wait(pending)
+
+    def replyTo(self, event: FakeEvent) -> int:
+        return self.client.replies[(event.chat_id, event.message.id)][1]
+
+    def latencies(self) -> list:
+        return [
+            self.client.replies[key][0] - dispatched
+            for key, dispatched in self.dispatched.items()
+            if key in self.client.replies
+        ]
+
+
+@scenario('burst')
+async def burstInOneGroup(bench: Bench, size: int):
+    # Everyone talks at once in a single 'messages' group, bursts should be coalesced into few replies
+    chat = bench.group(['messages'])
+    for i in range(size):
+        bench.dispatch(bench.event(chat, bench.users[i % len(bench.users)], f'Message number {i} of the burst, what do you think?'))
+        await asyncio.sleep(0.005)
+    await bench.drain()
+
+@scenario('idle_groups')
+async def manyIdleGroups(bench: Bench, size: int):
+    # Lots of groups the bot is in but has no triggers for, plus one active group in twenty
+    chats = [bench.group(['messages'] if i % 20 == 0 else None) for i in range(size)]
+    for turn in range(3):
+        for i, chat in enumerate(chats):
+            bench.dispatch(bench.event(chat, bench.users[(i+turn) % len(bench.users)], f'Just chatting in group {i}, round {turn}'))
+        await asyncio.sleep(0.01)
+    await bench.drain()
+
+@scenario('deep_thread')
+async def deepReplyThread(bench: Bench, size: int):
+    # One user keeps replying to the bot's latest answer, so the history and the thread index keep growing
+    chat = bench.group(['gpt_replies'])
+    user = bench.users[0]
+    event = bench.event(chat, user, '!fedorGPT Let us have a long conversation')
+    bench.dispatch(event)
+    await bench.drain()
+    for i in range(size):
+        reply_header = types.MessageReplyHeader(reply_to_msg_id=bench.replyTo(event))
+        event = bench.event(chat, user, f'Reply number {i}, tell me more', reply_to=reply_header)
+        bench.dispatch(event)
+        await bench.drain()
+
+@scenario('mixed')
+async def mixedMedia(bench: Bench, size: int):
+    # Photos, forwards, link previews and quotes, with photos repeating so the vision cache gets hits
+    chat = bench.group(['forwards', 'embeds', 'quotes'])
+    channel = bench.client.group(next(bench.entity_ids), 'Bench channel')
+    for i in range(size):
+        user = bench.users[i % len(bench.users)]
+        photo = bench.client.photo(1 + i % 5)
+        kind = i % 4
+        if kind == 0:
+            event = bench.event(chat, user, '!fedorGPT What is in this picture?', media=types.MessageMediaPhoto(photo=photo))
+        elif kind == 1:
+            event = bench.event(
+                chat, user, f'Forwarded post {i} with a picture',
+                fwd_from=types.MessageFwdHeader(date=datetime.now(timezone.utc), from_id=types.PeerChannel(channel.id)),
+                forward=SimpleNamespace(chat_id=utils.get_peer_id(channel)),
+                media=types.MessageMediaPhoto(photo=photo)
+            )
+        elif kind == 2:
+            webpage = types.WebPage(
+                id=i, url=f'https://example.com/{i}', display_url=f'example.com/{i}', hash=0,
+                type='article', site_name='Example', title=f'Article {i}', description='An article about benchmarks', photo=photo
+            )
+            event = bench.event(chat, user, f'Look at this https://example.com/{i}', media=types.MessageMediaWebPage(webpage=webpage))
+        else:
+            reply_header = types.MessageReplyHeader(
+                reply_to_msg_id=i, reply_to_peer_id=types.PeerChannel(channel.id), quote=True, quote_text='a quoted sentence from the channel'
+            )
+            event = bench.event(chat, user, 'Can you believe they wrote this?', reply_to=reply_header)
+        bench.dispatch(event)
+        await asyncio.sleep(0.02)
+    await bench.drain()
+
+@scenario('albums')
+async def forwardedAlbums(bench: Bench, size: int):
+    # Forwarded albums of up to ten photos, each album should get one reply and one completion
+    chat = bench.group(['forwards'])
+    channel = bench.client.group(next(bench.entity_ids), 'Bench channel')
+    for album in range(0, size, 10):
+        user = bench.users[album // 10 % len(bench.users)]
+        fwd_from = types.MessageFwdHeader(date=datetime.now(timezone.utc), from_id=types.PeerChannel(channel.id))
+        for i in range(album, min(size, album+10)):
+            bench.dispatch(bench.event(
+                chat, user, f'Album {album // 10} from the channel' if i == album else '',
+                fwd_from=fwd_from,
+                forward=SimpleNamespace(chat_id=utils.get_peer_id(channel)),
+                media=types.MessageMediaPhoto(photo=bench.client.photo(1 + i % 7)),
+                grouped_id=album+1
+            ))
+            await asyncio.sleep(0.005)
+    await bench.drain()
+
+
+def writeConfig(directory: str, base_url: str, args) -> str:
+    config = {
+        'telegram': {
+            'app_id': 1,
+            'api_hash': 'bench',
+            'session_file': os.path.join(directory, 'session_file')
+        },
+        'open_ai': {
+            'api_key': 'bench',
+            'base_url': base_url,
+            'text_model': 'gpt-3.5-turbo',
+            'text_max_tokens': 300,
+            'vision_model': 'gpt-4o',
+            'vision_max_tokens': 300
+        },
+        'system': {
+            'personal_settings_file': os.path.join(directory, 'settings.json'),
+            'logs_file': os.path.join(directory, 'fedorGPT.log'),
+            'chatdb_file': os.path.join(directory, 'chat.db'),
+            'chat_debounce': args.debounce,
+            'stream_replies': not args.no_stream,
+            'stream_edit_interval': 0.2,
+            'album_window': 0.2
+        }
+    }
+    if args.failover:
+        # Text goes to a backend nobody listens on first, so every reply exercises the router's failover
+        # until the dead target counts as unhealthy and is skipped
+        config['routing'] = {
+            'backends': {
+                'down': {'base_url': 'http://127.0.0.1:9/v1', 'api_key': 'bench'}
+            },
+            'routes': {
+                'text': [
+                    {'backend': 'down', 'model': 'gpt-3.5-turbo'},
+                    {'backend': 'openai', 'model': 'gpt-3.5-turbo'}
+                ]
+            }
+        }
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w') as config_file:
+        json.dump(config, config_file, indent=4)
+    return path
+
+async def runScenario(name: str, bench: Bench, server: FakeOpenAIServer, args) -> dict:
+    main = bench.main
+    main.METRICS.reset()
+    bench.client.calls.clear()
+    bench.dispatched.clear()
+    bench.events = 0
+    server.requests = 0
+    server.streamed = 0
+    if args.trace_memory:
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    await SCENARIOS[name](bench, args.size)
+    wall = time.perf_counter() - started
+    result = {
+        'events': bench.events,
+        'handled': len(bench.dispatched),
+        'replies': len(bench.latencies()),
+        'wall_seconds': wall,
+        'messages_per_second': bench.events / wall,
+        'reply_latency': percentiles(bench.latencies()),
+        'stages': {
+            stage: dict(zip(('p50', 'p95', 'p99'), histogram.quantiles().values()), count=histogram.count)
+            for stage, histogram in sorted(main.METRICS.histograms.items())
+        },
+        'counters': dict(sorted(main.METRICS.counters.items())),
+        'telegram_calls': dict(sorted(bench.client.calls.items())),
+        'openai_requests': server.requests,
+        'openai_streamed': server.streamed
+    }
+    if args.trace_memory:
+        result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+        # ru_maxrss is a high water mark for the whole process, so it only grows between scenarios
+        result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+async def benchmark(args) -> dict:
+    server = FakeOpenAIServer(args.first_token_latency, args.token_latency)
+    base_url = await server.start()
+    with tempfile.TemporaryDirectory(prefix='fedorgpt-bench-', ignore_cleanup_errors=True) as directory:
+        os.environ['FEDORGPT_CONFIG'] = writeConfig(directory, base_url, args)
+        # main reads the config at import time, so it's imported only once the config is in place
+        main = importlib.import_module('main')
+        main.startup()
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        me = types.User(id=1000, first_name='Fedor', last_name='GPT', username='fedorgpt', is_self=True)
+        client = FakeTelegramClient(me, args.telegram_latency)
+        main.TELEGRAM_CLIENT = client
+        main.ENTITIES.client = client
+        bench = Bench(main, client)
+        if args.trace_memory:
+            tracemalloc.start()
+        results = {}
+        for name in args.scenario:
+            results[name] = await runScenario(name, bench, server, args)
+            print(f'{name}: {results[name]["events"]} events, {results[name]["messages_per_second"]:.1f} msg/s, '
+                  f'reply p50 {results[name]["reply_latency"]["p50"]*1000:.0f}ms p95 {results[name]["reply_latency"]["p95"]*1000:.0f}ms', file=sys.stderr)
+        for task in main.TYPING_TASKS.values():
+            task.cancel()
+        await server.stop()
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': results
+    }
+
+def compare(current: dict, previous: dict) -> str:
+    def change(new: float, old: float) -> str:
+        return f'{(new-old)/old*100:+.1f}%' if old else 'n/a'
+    lines = []
+    for name, result in current['scenarios'].items():
+        before = previous.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        lines.append(f'{name}:')
+        lines.append(f'  messages_per_second {before["messages_per_second"]:.1f} -> {result["messages_per_second"]:.1f} ({change(result["messages_per_second"], before["messages_per_second"])})')
+        for quantile in ('p50', 'p95'):
+            new, old = result['reply_latency'][quantile], before['reply_latency'][quantile]
+            lines.append(f'  reply_latency {quantile} {old*1000:.0f}ms -> {new*1000:.0f}ms ({change(new, old)})')
+        for stage, stats in result['stages'].items():
+            if stage in before['stages']:
+                new, old = stats['p95'], before['stages'][stage]['p95']
+                lines.append(f'  {stage} p95 {old*1000:.1f}ms -> {new*1000:.1f}ms ({change(new, old)})')
+    return '\n'.join(lines)
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Replay synthetic Telegram traffic through the handler against fake Telegram and OpenAI backends')
+    parser.add_argument('--scenario', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--size', type=int, default=40, help='messages (or groups, or thread depth) per scenario')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='seconds per fake Telegram request')
+    parser.add_argument('--first-token-latency', type=float, default=0.3, help='seconds before the fake OpenAI server answers')
+    parser.add_argument('--token-latency', type=float, default=0.01, help='seconds between streamed tokens')
+    parser.add_argument('--debounce', type=float, default=0.1, help='chat_debounce used by the scheduler')
+    parser.add_argument('--no-stream', action='store_true', help='disable stream_replies')
+    parser.add_argument('--failover', action='store_true', help='route text through an unreachable backend first')
+    parser.add_argument('--trace-memory', action='store_true', help='report the tracemalloc peak per scenario (slower)')
+    parser.add_argument('--verbose', action='store_true', help='keep the bot\'s INFO logging')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArguments()
+    results = asyncio.run(benchmark(args))
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare is not None:
+        with open(args.compare, 'r') as previous_file:
+            print(compare(results, json.load(previous_file)), file=sys.stderr)
@@ -0,0 +1,103 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+
+class CatchUp:
+    # Separates the backlog Telegram replays after a restart or a reconnect from live traffic. A message sent before
+    # the bot started, or more than live_age seconds ago, is backlog: older than max_age it's skipped, otherwise it
+    # waits in a heap and a single worker handles it newest first, only while no live message is being handled
+
+    def __init__(self, started: float, max_age: float = 600, live_age: float = 60, max_backlog: int = 200):
+        self.started = started
+        self.max_age = max_age
+        self.live_age = live_age
+        self.max_backlog = max_backlog
+        # (-sent, sequence, event, handler), so the newest message pops first
+        self.backlog : list = []
+        self.sequence = itertools.count()
+        self.live = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.worker = None
+        self.round_started = 0.0
+        self.rounds = 0
+        self.queued = 0
+        self.handled = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+
+    def isBacklog(self, sent: float) -> bool:
+        return sent < self.started or time.time() - sent > self.live_age
+
+    def hold(self):
+        # Live work that outlives its handler (e.g. queued in the scheduler) counts as live until release()
+        self.live += 1
+        self.idle.clear()
+
+    def release(self):
+        self.live -= 1
+        if self.live == 0:
+            self.idle.set()
+
+    async def dispatch(self, event, handler):
+        sent = event.message.date.timestamp()
+        if not self.isBacklog(sent):
+            self.hold()
+            try:
+                await handler(event)
+            finally:
+                self.release()
+            return
+        if time.time() - sent > self.max_age:
+            self.skipped += 1
+            return
+        heapq.heappush(self.backlog, (-sent, next(self.sequence), event, handler))
+        self.queued += 1
+        if len(self.backlog) > self.max_backlog:
+            # Over capacity the oldest message goes, it's the least worth answering
+            self.backlog.remove(max(self.backlog))
+            heapq.heapify(self.backlog)
+            self.dropped += 1
+        if self.worker is None:
+            self.rounds += 1
+            self.round_started = time.monotonic()
+            self.worker = asyncio.ensure_future(self.work())
+
+    async def work(self):
+        while len(self.backlog) > 0:
+            # Live messages go first, the backlog only moves while they're all done
+            await self.idle.wait()
+            if len(self.backlog) == 0:
+                break
+            negative_sent, _, event, handler = heapq.heappop(self.backlog)
+            lag = time.time() + negative_sent
+            if lag > self.max_age:
+                self.skipped += 1
+                continue
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                await handler(event)
+            except Exception:
+                logging.exception(f'Failed to handle backlog message {event.message.id} in chat {event.chat_id}')
+            self.handled += 1
+        self.worker = None
+        logging.info(f'Caught up in {time.monotonic() - self.round_started:.1f}s: {self.summary()}')
+
+    def summary(self) -> str:
+        return f'{self.handled} of {self.queued} backlog messages handled newest first, {self.skipped} older than {self.max_age:.0f}s skipped, {self.dropped} dropped over capacity, {len(self.backlog)} waiting'
+
+    def stats(self) -> dict:
+        return {
+            'rounds': self.rounds,
+            'waiting': len(self.backlog),
+            'queued': self.queued,
+            'handled': self.handled,
+            'skipped': self.skipped,
+            'dropped': self.dropped,
+            'max_lag': self.max_lag,
+            'live_in_flight': self.live
+        }
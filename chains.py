@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_openai import ChatOpenAI
+from history import HistoryStore
+import logging
+
+
+class ChainRegistry:
+    # Keeps one LLM client per router target, one history store and a bounded LRU of compiled chains for the process.
+    # Chains are keyed by (user_id, chat_id, target) and rebuilt whenever the system prompt template for the key changes
+
+    def __init__(self, clients, history: HistoryStore, text_max_tokens: int, max_chains: int = 256):
+        # clients(backend) returns the AsyncOpenAI client of a routing backend
+        self.clients = clients
+        self.history = history
+        self.text_max_tokens = text_max_tokens
+        self.llms : dict = {}
+        self.max_chains = max_chains
+        self.chains : OrderedDict = OrderedDict()
+
+    def llm(self, target) -> ChatOpenAI:
+        llm = self.llms.get(target.key)
+        if llm is None:
+            client = self.clients(target.backend)
+            # Reuse the backend's AsyncOpenAI connection pool for text completions too
+            llm = ChatOpenAI(
+                openai_api_key=client.api_key,
+                async_client=client.chat.completions,
+                model=target.model,
+                max_tokens=target.max_tokens or self.text_max_tokens
+            )
+            self.llms[target.key] = llm
+        return llm
+
+    def buildChain(self, system_template: str, llm: ChatOpenAI):
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system_template),
+                MessagesPlaceholder(variable_name="history"),
+                # Whatever changes every call goes last, so everything above it can be served from the prompt cache
+                ("system", "{context}"),
+                ("human", "{message}"),
+            ]
+        )
+        return RunnableWithMessageHistory(
+            prompt | llm,
+            self.history.getHistory,
+            input_messages_key="message",
+            history_messages_key="history",
+        )
+
+    def getChain(self, user_id, chat_id, system_template: str, target):
+        key = (str(user_id), str(chat_id), target.key)
+        cached = self.chains.get(key)
+        if cached is not None and cached[0] == system_template:
+            self.chains.move_to_end(key)
+            return cached[1]
+        chain = self.buildChain(system_template, self.llm(target))
+        self.chains[key] = (system_template, chain)
+        self.chains.move_to_end(key)
+        while len(self.chains) > self.max_chains:
+            self.chains.popitem(last=False)
+        return chain
+
+    def evict(self, user_id=None, chat_id=None):
+        # Drop every chain matching the given user and/or chat on any target, e.g. after a prompt change
+        stale = [
+            key for key in self.chains
+            if (user_id is None or key[0] == str(user_id)) and (chat_id is None or key[1] == str(chat_id))
+        ]
+        for key in stale:
+            del self.chains[key]
+        logging.debug(f'Evicted {len(stale)} cached chains for user {user_id} chat {chat_id}')
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from telethon import utils
+import asyncio
+import math
+import time
+
+
+def displayName(entity) -> str:
+    # Chat title for groups and channels, full name for users
+    if hasattr(entity, 'title'):
+        return entity.title
+    return f'{entity.first_name} {entity.last_name}'
+
+def originName(entity) -> str:
+    # Name used when describing where a forward or a quote came from
+    origin_name = getattr(entity, 'username', None)
+    if hasattr(entity, 'title') and entity.title is not None:
+        origin_name = entity.title
+    if hasattr(entity, 'first_name') and entity.first_name is not None:
+        origin_name = entity.first_name + ('' if entity.last_name is None else (' '+entity.last_name))
+    return origin_name
+
+def peerKey(peer):
+    if isinstance(peer, str):
+        return 'username:'+peer.lstrip('@').lower()
+    return utils.get_peer_id(peer)
+
+
+class CachedEntity:
+    __slots__ = ('entity', 'expires', 'display_name', 'origin_name')
+
+    def __init__(self, entity, expires: float):
+        self.entity = entity
+        self.expires = expires
+        self.display_name = displayName(entity)
+        self.origin_name = originName(entity)
+
+
+class EntityCache:
+    # TTL + LRU cache in front of TelegramClient.get_entity/get_me/event.get_sender.
+    # Concurrent lookups of the same peer share a single request, which goes through the limiter if there is one
+
+    def __init__(self, client, ttl: float = 600, max_size: int = 2048, limiter=None):
+        self.client = client
+        self.limiter = limiter
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries : OrderedDict = OrderedDict()
+        self.pending : dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+
+    def store(self, key, entity, expires: float):
+        entry = CachedEntity(entity, expires)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        # Lookups by username also become reachable by id
+        if isinstance(key, str) and key != 'me':
+            self.entries[utils.get_peer_id(entity)] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def fetch(self, key, factory, ttl: float = None):
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.entity
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.deduplicated += 1
+            return await asyncio.shield(pending)
+        self.misses += 1
+        task = asyncio.ensure_future(factory() if self.limiter is None else self.limiter.call('telegram.read', factory))
+        self.pending[key] = task
+        try:
+            entity = await asyncio.shield(task)
+        finally:
+            self.pending.pop(key, None)
+        if entity is not None:
+            self.store(key, entity, time.monotonic() + (self.ttl if ttl is None else ttl))
+        return entity
+
+    async def getMe(self):
+        # Our own account doesn't change while we're connected, so it's cached for good
+        return await self.fetch('me', self.client.get_me, ttl=math.inf)
+
+    async def get(self, peer):
+        return await self.fetch(peerKey(peer), lambda: self.client.get_entity(peer))
+
+    async def getSender(self, event):
+        if event.sender_id is None:
+            return None
+        return await self.fetch(event.sender_id, event.get_sender)
+
+    def entryFor(self, entity):
+        if not hasattr(entity, 'id') or not isinstance(entity.id, int):
+            return None
+        try:
+            return self.entries.get(utils.get_peer_id(entity))
+        except TypeError:
+            return None
+
+    def displayName(self, entity) -> str:
+        entry = self.entryFor(entity)
+        return entry.display_name if entry is not None else displayName(entity)
+
+    async def originName(self, peer) -> str:
+        entity = await self.get(peer)
+        entry = self.entries.get(peerKey(peer))
+        return entry.origin_name if entry is not None else originName(entity)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.deduplicated
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'deduplicated': self.deduplicated,
+            'hit_rate': (self.hits + self.deduplicated) / lookups if lookups > 0 else 0.0
+        }
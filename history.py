@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_community.chat_message_histories.sql import DefaultMessageConverter
+from langchain_core.messages import HumanMessage, SystemMessage
+from metrics import METRICS
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sessions import SessionRegistry
+import logging
+import sqlite3
+import threading
+import tiktoken
+
+SUMMARY_PROMPT = 'You maintain a running summary of an online chat conversation. Merge the previous summary with the new messages into one concise summary that keeps names, facts, opinions and open questions. Reply with the summary only.'
+
+
+class SharedSQLChatMessageHistory(SQLChatMessageHistory):
+    # Same as SQLChatMessageHistory, but borrows the engine, session factory and ORM model from
+    # the HistoryStore instead of creating a new engine (and re-running CREATE TABLE) per session.
+    # Only the most recent messages that fit the token budget are loaded, older ones are replaced by a summary
+    def __init__(self, session_id: str, store: 'HistoryStore'):
+        self.connection_string = store.connection_string
+        self.engine = store.engine
+        self.session_id_field_name = 'session_id'
+        self.converter = store.converter
+        self.sql_model_class = store.sql_model_class
+        self.session_id = session_id
+        self.Session = store.Session
+        self.store = store
+
+    @property
+    def messages(self):
+        with METRICS.timer('history'):
+            messages, excluded_id, used = self.store.window(self.session_id)
+        METRICS.count('prompt_history_tokens', used)
+        if excluded_id is None:
+            return messages
+        summary, covered_id = self.store.getSummary(self.session_id)
+        if covered_id < excluded_id:
+            self.store.pending[self.session_id] = excluded_id
+        if len(summary) > 0:
+            summary_message = SystemMessage(content=f'Summary of the earlier conversation: {summary}')
+            METRICS.count('prompt_summary_tokens', self.store.countTokens(summary_message.content))
+            return [summary_message] + messages
+        return messages
+
+    def add_message(self, message) -> None:
+        super().add_message(message)
+        if self.store.sessions is not None:
+            self.store.sessions.add(self.session_id)
+
+
+class HistoryStore:
+    # Owns the pooled message_store engine and the per session running summaries (session_summaries table).
+    # window() walks a session backwards in LIMIT sized batches until token_budget is used up, so the cost of
+    # a turn doesn't depend on how long the thread is; summarize() folds what fell out of the window into the summary
+
+    def __init__(self, chatdb_file: str, text_model: str, token_budget: int = 2000, sessions: SessionRegistry = None, batch_size: int = 20, max_summaries: int = 1024):
+        self.sessions = sessions
+        self.connection_string = f'sqlite:///{chatdb_file}'
+        self.engine = create_engine(self.connection_string, echo=False)
+        self.Session = sessionmaker(self.engine)
+        self.converter = DefaultMessageConverter('message_store')
+        self.sql_model_class = self.converter.get_sql_model_class()
+        self.sql_model_class.metadata.create_all(self.engine)
+
+        self.connection = sqlite3.connect(chatdb_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS session_summaries (
+                    session_id TEXT NOT NULL PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    covered_id INTEGER NOT NULL
+                )
+            ''')
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(text_model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('cl100k_base')
+        self.token_budget = token_budget
+        self.batch_size = batch_size
+        self.max_summaries = max_summaries
+        self.summaries : OrderedDict = OrderedDict()
+        # session_id -> newest message id that fell out of the window but isn't summarised yet
+        self.pending : dict = {}
+
+    def getHistory(self, session_id: str) -> SharedSQLChatMessageHistory:
+        return SharedSQLChatMessageHistory(session_id, self)
+
+    def countTokens(self, text) -> int:
+        # +4 for the per message role/separator overhead of the chat format
+        return len(self.encoding.encode(str(text))) + 4
+
+    def window(self, session_id: str) -> tuple:
+        # Returns (messages oldest first, id of the newest message left out or None, their tokens)
+        model = self.sql_model_class
+        messages = []
+        used = 0
+        before = None
+        with self.Session() as session:
+            while True:
+                query = session.query(model).where(model.session_id == session_id)
+                if before is not None:
+                    query = query.where(model.id < before)
+                rows = query.order_by(model.id.desc()).limit(self.batch_size).all()
+                for row in rows:
+                    message = self.converter.from_sql_model(row)
+                    tokens = self.countTokens(message.content)
+                    if used + tokens > self.token_budget and len(messages) > 0:
+                        messages.reverse()
+                        return messages, row.id, used
+                    used += tokens
+                    messages.append(message)
+                    before = row.id
+                if len(rows) < self.batch_size:
+                    messages.reverse()
+                    return messages, None, used
+
+    def getSummary(self, session_id: str) -> tuple:
+        # Returns (summary, id of the last message it covers)
+        cached = self.summaries.get(session_id)
+        if cached is None:
+            with self.lock:
+                cached = self.connection.execute('SELECT summary, covered_id FROM session_summaries WHERE session_id = ?', (session_id,)).fetchone()
+            cached = cached if cached is not None else ('', 0)
+            self.summaries[session_id] = cached
+        self.summaries.move_to_end(session_id)
+        while len(self.summaries) > self.max_summaries:
+            self.summaries.popitem(last=False)
+        return cached
+
+    def forget(self, session_ids: list):
+        # Drops cached state of sessions removed from the database
+        for session_id in session_ids:
+            self.summaries.pop(session_id, None)
+            self.pending.pop(session_id, None)
+
+    def needsSummary(self, session_id: str) -> bool:
+        return session_id in self.pending
+
+    async def summarize(self, session_id: str, llm):
+        # Folds messages up to the newest one outside the window into the running summary, one budget sized chunk per call
+        target_id = self.pending.pop(session_id, None)
+        if target_id is None:
+            return
+        summary, covered_id = self.getSummary(session_id)
+        model = self.sql_model_class
+        transcript = []
+        used = 0
+        last_id = covered_id
+        with self.Session() as session:
+            rows = session.query(model).where(model.session_id == session_id, model.id > covered_id, model.id <= target_id).order_by(model.id.asc()).all()
+        for row in rows:
+            message = self.converter.from_sql_model(row)
+            tokens = self.countTokens(message.content)
+            if used + tokens > self.token_budget and len(transcript) > 0:
+                break
+            transcript.append(f'{message.type}: {message.content}')
+            used += tokens
+            last_id = row.id
+        if len(transcript) == 0:
+            return
+        try:
+            response = await llm.ainvoke([
+                SystemMessage(content=SUMMARY_PROMPT),
+                HumanMessage(content=f'Previous summary: {summary}\n\nNew messages:\n'+'\n'.join(transcript))
+            ])
+        except:
+            # Put the work back so a retry picks it up again
+            self.pending.setdefault(session_id, target_id)
+            raise
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO session_summaries (session_id, summary, covered_id) VALUES (?, ?, ?)',
+                (session_id, response.content, last_id)
+            )
+        self.summaries[session_id] = (response.content, last_id)
+        logging.info(f'Folded {len(transcript)} messages of session {session_id} into its summary')
@@ -0,0 +1,33 @@
+import logging
+import threading
+import time
+
+
+class Lazy:
+    # Stands in for an object that is expensive to create (heavy imports, API clients, tokenizers): factory()
+    # runs on first attribute access, or earlier when pre-warming calls resolve() from a worker thread,
+    # and every attribute access is forwarded to the real object after that
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    started = time.perf_counter()
+                    self._value = self._factory()
+                    logging.info(f'Created {self._name} in {time.perf_counter() - started:.2f}s')
+                value = self._value
+        return value
+
+    @property
+    def resolved(self) -> bool:
+        return self._value is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self.resolve(), name)
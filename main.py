@@ -1,120 +1,245 @@
 #! python3
 
+# Imported first, so the startup clock includes the other imports
+from metrics import METRICS, STARTUP
+import asyncio
 import base64
-from datetime import datetime
+from contextlib import asynccontextmanager
 from io import BytesIO
-from uu import encode
-from exceptiongroup import catch
-from openai import NoneType, OpenAI
 from telethon import TelegramClient, events, types
 from telethon.tl.functions.messages import SendReactionRequest, SetTypingRequest
-from telethon.tl.functions.channels import GetMessagesRequest
-from threading import Lock
 import json
 import logging
 import os
 import sys
 import telethon
 import time
-from typing import Optional
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_message_histories import SQLChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_openai import ChatOpenAI
-import sqlite3
+import weakref
+from albums import AlbumBuffer
+from catchup import CatchUp
+from lazy import Lazy
+from maintenance import ChatDbMaintenance
+from sessions import SessionRegistry, sessionId, MESSAGE_FROM_GPT, MESSAGE_FROM_ME, MESSAGE_FROM_OTHER
+from entities import EntityCache
+from mixins import MixinRegistry
+from policy import PolicyIndex
+from prefilter import PreFilter
+from prompts import PromptLayout
+from ratelimit import RateLimiter
+from router import ModelRouter
+from scheduler import ChatScheduler, ScheduledItem
+from settings import SettingsStore
+from vision import DescriptionCache, photoKey, contentKey, pickPhotoSize, preprocessImage, estimateImageTokens
 
 # TODO: Split into separate files this is getting comically large
 # TODO: replace property getters with get_ function calls, see https://docs.telethon.dev/en/stable/concepts/updates.html#properties-vs-methods
 # TODO: add multithreading
 
-with open('config.json', 'r') as config_file:
+# langchain, the OpenAI SDK, SQLAlchemy, tiktoken and PIL are only imported when something first needs them
+STARTUP.mark('imports')
+
+# FEDORGPT_CONFIG lets the benchmarks point the bot at a throwaway config
+with open(os.environ.get('FEDORGPT_CONFIG', 'config.json'), 'r') as config_file:
     CONFIG = json.load(config_file)
 
-os.makedirs(os.path.dirname(CONFIG['system']['personal_settings_file']), exist_ok=True)
-os.makedirs(os.path.dirname(CONFIG['system']['logs_file']), exist_ok=True)
-os.makedirs(os.path.dirname(CONFIG['system']['chatdb_file']), exist_ok=True)
-os.makedirs(os.path.dirname(CONFIG['telegram']['session_file']), exist_ok=True)
+SETTINGS_DB_FILE = CONFIG['system'].get('settings_db_file', os.path.splitext(CONFIG['system']['personal_settings_file'])[0]+'.db')
+STARTUP.mark('config')
+
+# Every OpenAI and Telegram request goes through LIMITER, which owns retries, FloodWaits and throttling,
+# so the clients' own retry and flood sleep logic is turned off
+LIMITER = RateLimiter(
+    CONFIG['system'].get('rate_limits', {}),
+    CONFIG['system'].get('retry_attempts', 5),
+    CONFIG['system'].get('retry_base_delay', 1.0),
+    CONFIG['system'].get('retry_max_delay', 60),
+    CONFIG['system'].get('retry_max_wait', 300)
+)
+
+# Created at startup by buildTelegramClient(), so the module can be imported without a session
+TELEGRAM_CLIENT : TelegramClient = None
 
-# Telethon stores API session credentials and caches in a file on disk
-TELEGRAM_CLIENT = TelegramClient(
-    CONFIG['telegram']['session_file'],
-    CONFIG['telegram']['app_id'],
-    CONFIG['telegram']['api_hash']
+def buildTelegramClient() -> TelegramClient:
+    # Telethon stores API session credentials and caches in a file on disk
+    return TelegramClient(
+        CONFIG['telegram']['session_file'],
+        CONFIG['telegram']['app_id'],
+        CONFIG['telegram']['api_hash'],
+        flood_sleep_threshold=0
+    )
+
+ENTITIES = EntityCache(
+    None,
+    CONFIG['system'].get('entity_cache_ttl', 600),
+    CONFIG['system'].get('entity_cache_size', 2048),
+    LIMITER
 )
 
 OPENAI_API_KEY = CONFIG['open_ai']['api_key']
 
-OPENAI = OpenAI(api_key=OPENAI_API_KEY)
-USERS_LOCK = Lock()
-
-def loadUsersAndChats():
-    with USERS_LOCK as _:
-        if not os.path.exists(CONFIG['system']['personal_settings_file']):
-            return {"USERS": {}, "CHATS": {}}
-        with open(CONFIG['system']['personal_settings_file'], 'r') as personal_settings_file:
-            return json.load(personal_settings_file)
-
-def dumpUsersAndChats(users_and_chats):
-    with USERS_LOCK as _:
-        if os.path.exists(CONFIG['system']['personal_settings_file']):
-            with open(CONFIG['system']['personal_settings_file'], 'r') as personal_settings_file:
-                loaded_users : dict = json.load(personal_settings_file)
-        else:
-            loaded_users = {}
-        loaded_users.update(users_and_chats)
-        with open(CONFIG['system']['personal_settings_file'], 'w') as personal_settings_file:
-            json.dump(loaded_users, personal_settings_file, indent=2, ensure_ascii=False)
-
-def getChain(initialPrompt):
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", initialPrompt),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{message}"),
-        ]
+def buildOpenAI(settings: dict):
+    from openai import AsyncOpenAI
+    import httpx
+    # Keep idle connections long enough for a pre-warmed one to still be there for the first reply
+    return AsyncOpenAI(
+        api_key=settings.get('api_key', 'none'),
+        base_url=settings.get('base_url'),
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=settings.get('keepalive_expiry', 120)),
+            follow_redirects=True
+        )
     )
-    chain = prompt | ChatOpenAI(
-        openai_api_key=OPENAI_API_KEY,
-        model=CONFIG['open_ai']['text_model'],
-        max_tokens=CONFIG['open_ai']['text_max_tokens']
+
+# Every backend speaks the OpenAI API: 'openai' comes from the open_ai section, routing.backends adds others
+# (a local llama.cpp or vLLM server, another provider's compatible endpoint) by name
+ROUTING : dict = CONFIG.get('routing', {})
+BACKENDS = {
+    name: Lazy(f'{name} client', lambda settings=settings: buildOpenAI(settings))
+    for name, settings in {
+        'openai': {
+            'api_key': OPENAI_API_KEY,
+            'base_url': CONFIG['open_ai'].get('base_url'),
+            'keepalive_expiry': CONFIG['open_ai'].get('keepalive_expiry', 120)
+        },
+        **ROUTING.get('backends', {})
+    }.items()
+}
+
+# A route routing.routes leaves out uses the open_ai model, which still gets health tracking.
+# routing.chats is keyed by the chat id the chat settings use, without the -100 prefix
+ROUTER = ModelRouter(
+    {
+        'text': [{'backend': 'openai', 'model': CONFIG['open_ai']['text_model']}],
+        'vision': [{'backend': 'openai', 'model': CONFIG['open_ai']['vision_model']}],
+        **ROUTING.get('routes', {})
+    },
+    ROUTING.get('chats', {}),
+    ROUTING.get('long_input_tokens', 0),
+    ROUTING.get('max_p95', 30),
+    ROUTING.get('max_error_rate', 0.5),
+    ROUTING.get('min_samples', 5),
+    ROUTING.get('health_horizon', 300),
+    ROUTING.get('failover_attempts', 2)
+)
+
+# Limits on in-flight OpenAI calls, globally and per chat, so a burst in one chat can't starve the others
+LLM_SEMAPHORE = asyncio.Semaphore(CONFIG['system'].get('max_concurrent_requests', 8))
+CHAT_SEMAPHORES : weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+@asynccontextmanager
+async def llmSlot(chat_id):
+    chat_semaphore = CHAT_SEMAPHORES.get(chat_id)
+    if chat_semaphore is None:
+        chat_semaphore = asyncio.Semaphore(CONFIG['system'].get('max_concurrent_requests_per_chat', 2))
+        CHAT_SEMAPHORES[chat_id] = chat_semaphore
+    async with chat_semaphore:
+        async with LLM_SEMAPHORE:
+            yield
+
+# Created by startup(), so importing main doesn't create directories, open the log file or touch any database
+SESSIONS : SessionRegistry = None
+SETTINGS : SettingsStore = None
+VISION_CACHE : DescriptionCache = None
+MAINTENANCE : ChatDbMaintenance = None
+
+def buildHistory():
+    from history import HistoryStore
+    return HistoryStore(
+        CONFIG['system']['chatdb_file'],
+        CONFIG['open_ai']['text_model'],
+        CONFIG['open_ai'].get('history_token_budget', 2000),
+        SESSIONS
     )
-    chain_with_history = RunnableWithMessageHistory(
-        chain,
-        lambda session_id: SQLChatMessageHistory(
-            session_id=session_id, connection_string=f'sqlite:///{CONFIG["system"]["chatdb_file"]}'
-        ),
-        input_messages_key="message",
-        history_messages_key="history",
+
+HISTORY = Lazy('history store', buildHistory)
+
+PROMPTS = PromptLayout(lambda text: HISTORY.countTokens(text), CONFIG['system'].get('max_cached_prompts', 1024))
+
+def buildChains():
+    from chains import ChainRegistry
+    return ChainRegistry(
+        lambda backend: BACKENDS[backend].resolve(),
+        HISTORY.resolve(),
+        CONFIG['open_ai']['text_max_tokens'],
+        CONFIG['system'].get('max_cached_chains', 256)
     )
-    return chain_with_history
-
-
-logging.basicConfig(
-    format='%(asctime)s.%(msecs)d %(name)s %(levelname)s %(message)s',
-    datefmt='%H:%M:%S',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(
-            CONFIG['system']['logs_file'],
-            mode='a'
-        ),
-        logging.StreamHandler(sys.stdout)
-    ]
+
+CHAINS = Lazy('chain registry', buildChains)
+
+MIXINS = MixinRegistry(
+    CONFIG['system'].get('mixin_timeout', 45),
+    CONFIG['system'].get('mixin_deadline', 60),
+    CONFIG['system'].get('mixin_timeouts', {})
 )
 
+def startup():
+    # Everything with side effects on disk: data directories, logging, the SQLite stores and the settings.
+    # Called from __main__ and by the benchmarks before the first message
+    global SESSIONS, SETTINGS, VISION_CACHE, MAINTENANCE
+    os.makedirs(os.path.dirname(CONFIG['system']['personal_settings_file']), exist_ok=True)
+    os.makedirs(os.path.dirname(SETTINGS_DB_FILE), exist_ok=True)
+    os.makedirs(os.path.dirname(CONFIG['system']['logs_file']), exist_ok=True)
+    os.makedirs(os.path.dirname(CONFIG['system']['chatdb_file']), exist_ok=True)
+    os.makedirs(os.path.dirname(CONFIG['telegram']['session_file']), exist_ok=True)
+
+    logging.basicConfig(
+        format='%(asctime)s.%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S',
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(
+                CONFIG['system']['logs_file'],
+                mode='a'
+            ),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+    SESSIONS = SessionRegistry(CONFIG['system']['chatdb_file'])
+
+    SETTINGS = SettingsStore(SETTINGS_DB_FILE)
+    SETTINGS.migrateFromJson(CONFIG['system']['personal_settings_file'])
+    TARGETED_INDIVIDUALS.update(SETTINGS.load())
+    POLICIES.reload()
+
+    VISION_CACHE = DescriptionCache(CONFIG['system']['chatdb_file'], CONFIG['system'].get('vision_cache_size', 1024))
+    METRICS.registerGauges('vision_cache', VISION_CACHE.stats)
+
+    MAINTENANCE = ChatDbMaintenance(
+        CONFIG['system']['chatdb_file'],
+        SESSIONS,
+        HISTORY,
+        CONFIG['system'].get('session_idle_days', 90),
+        CONFIG['system'].get('session_max_age_days', 0),
+        CONFIG['system'].get('session_max_messages', 500),
+        CONFIG['system'].get('chat_archive_file'),
+        CONFIG['system'].get('image_description_max_age_days', 180),
+        CONFIG['system'].get('vacuum_pages', 0),
+        CONFIG['system'].get('vacuum_step', 256)
+    )
+    # VACUUM locks chat.db for as long as it runs, so an old file is rebuilt here, before any message is handled
+    if MAINTENANCE.needs_rebuild:
+        MAINTENANCE.rebuild()
+    METRICS.registerGauges('chatdb', MAINTENANCE.stats)
+    STARTUP.mark('stores')
 
 
 
+
+async def sendReply(target, text: str):
+    # target is anything with .reply(), an event or a message
+    return await LIMITER.call('telegram.send', lambda: target.reply(text))
+
 async def react(message: types.Message, reacts: list):
     for react in reacts:
         try:
-            await TELEGRAM_CLIENT(SendReactionRequest(
+            await LIMITER.call('telegram.reaction', lambda: TELEGRAM_CLIENT(SendReactionRequest(
                 peer=message.peer_id,
                 msg_id=message.id,
                 reaction=[types.ReactionEmoji(
                     emoticon=react
                 )]
-            ))
+            )))
             return react
         except:
             logging.warning(f'Failed to react with {react} to {message.id} for peer {message.peer_id}')
@@ -123,38 +248,183 @@ async def react(message: types.Message, reacts: list):
 async def reactOrReply(message: types.Message, reacts: list, fallback: str):
     reactSent = await react(message, reacts)
     if reactSent == -1:
-        await message.reply("🤖 "+fallback)
+        await sendReply(message, "🤖 "+fallback)
 
-def getChatGPT4ImageDesc(image : BytesIO):
-    encoded_image = base64.b64encode(image.read()).decode('utf-8')
-    logging.info(f'Sending image of {sys.getsizeof(image)} bytes to {CONFIG["open_ai"]["vision_model"]} for a description')
+async def getChatGPT4ImageDesc(image : BytesIO, chat_id):
     try:
-        response = OPENAI.chat.completions.create(
-            model=CONFIG['open_ai']['vision_model'],
+        # Decoding and re-encoding with Pillow can take a while for large screenshots, keep it off the event loop
+        data, mime_type, width, height = await asyncio.get_running_loop().run_in_executor(
+            None,
+            preprocessImage,
+            image,
+            CONFIG['open_ai'].get('vision_max_dimension', 1024),
+            CONFIG['open_ai'].get('vision_max_bytes', 1024*1024)
+        )
+    except:
+        logging.warning(f'Failed to decode image for a description')
+        return ''
+    encoded_image = base64.b64encode(data).decode('utf-8')
+    del data
+    tokens = estimateImageTokens(width, height)+CONFIG['open_ai']['vision_max_tokens']
+    route, targets = ROUTER.route('vision', chat_id, tokens)
+    logging.info(f'Sending {width}x{height} {mime_type} image of {len(encoded_image)} bytes (~{estimateImageTokens(width, height)} tokens) to {targets[0].key} for a description')
+    def describe(target, call):
+        return LIMITER.call(target.key, lambda: BACKENDS[target.backend].chat.completions.create(
+            model=target.model,
             messages=[
                 { "role": "system", "content" : [
                     {"type": "text", "text": "You are provided an image and a text message. Describe the image with as many details as possible"}
                 ]},
                 { "role": "user", "content": [
-                    { "type": "image_url", "image_url": { "url": f"data:image/jpeg;base64,{encoded_image}" }},
+                    { "type": "image_url", "image_url": { "url": f"data:{mime_type};base64,{encoded_image}" }},
                 ]}
             ],
-            max_tokens=CONFIG['open_ai']['vision_max_tokens'],
+            max_tokens=target.max_tokens or CONFIG['open_ai']['vision_max_tokens'],
             timeout=60
-        )
+        ), tokens, call.attempts)
+    try:
+        async with llmSlot(chat_id), METRICS.timer('vision'):
+            response = await ROUTER.call(route, targets, describe, tokens)
+        METRICS.count('vision_bytes', len(encoded_image))
+        if response.usage is not None:
+            METRICS.count('vision_prompt_tokens', response.usage.prompt_tokens)
+            METRICS.count('vision_completion_tokens', response.usage.completion_tokens)
         logging.debug(f'Recieved image description: {response.choices[0].message.content}')
         return response.choices[0].message.content
-    except:
-        logging.warning(f'Failed to recieve image description')
+    except Exception as e:
+        logging.warning(f'Failed to recieve image description: {type(e).__name__}')
         return ''
 
-def knownSession(sessionId):
+async def describePhoto(photo, chat_id):
+    # Vision descriptions are cached by Telegram photo id, then by content hash once the bytes are downloaded
+    photo_key = photoKey(photo)
+    description = VISION_CACHE.get(photo_key)
+    if description is not None:
+        logging.info(f'Using cached image description for {photo_key}')
+        return description
+    image_bytes = BytesIO()
+    async def download():
+        # A retried download starts over
+        image_bytes.seek(0)
+        image_bytes.truncate()
+        await TELEGRAM_CLIENT.download_media(photo, image_bytes, thumb=pickPhotoSize(photo, CONFIG['open_ai'].get('vision_max_dimension', 1024)))
+    with METRICS.timer('download'):
+        await LIMITER.call('telegram.download', download)
+    size = image_bytes.tell()
+    METRICS.count('download_bytes', size)
+    image_bytes.seek(0)
+    content_key = contentKey(image_bytes.getbuffer())
+    description = VISION_CACHE.get(content_key)
+    if description is None:
+        description = await getChatGPT4ImageDesc(image_bytes, chat_id)
+        if len(description) == 0:
+            return description
+        VISION_CACHE.put(content_key, description, size)
+    VISION_CACHE.put(photo_key, description, size)
+    return description
+
+@MIXINS.register('image')
+async def getImageMixin(message):
+    photos = [part.media.photo for part in ALBUMS.members(message) if isinstance(part.media, telethon.types.MessageMediaPhoto)]
+    if len(photos) == 0:
+        return {}
+    if len(photos) == 1:
+        return {
+            'image_desc': await describePhoto(photos[0], message.chat_id)
+        }
+    # An album's photos are downloaded and described concurrently, each description is cached on its own.
+    # llmSlot lets only a few run per chat, so a big album can outlast the mixin timeout: stop a little before
+    # it and keep the descriptions that are ready instead of losing all of them
+    tasks = [asyncio.ensure_future(describePhoto(photo, message.chat_id)) for photo in photos]
     try:
-        con = sqlite3.connect(CONFIG["system"]["chatdb_file"])
-        count = con.execute(f'SELECT COUNT(id) FROM message_store WHERE session_id={sessionId}').fetchone()[0]
-        return count > 0
+        _, pending = await asyncio.wait(tasks, timeout=MIXINS.budget('image')*0.9)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if len(pending) > 0:
+        logging.warning(f'Describing album {message.grouped_id} ran out of time, {len(pending)} of {len(photos)} photos left out')
+    descriptions = []
+    for task in tasks:
+        if task in pending or task.cancelled():
+            continue
+        if task.exception() is not None:
+            logging.warning(f'Failed to describe a photo of album {message.grouped_id}: {task.exception()!r}')
+        elif len(task.result()) > 0:
+            descriptions.append(task.result())
+    return {
+        'image_desc': descriptions
+    }
+
+@MIXINS.register('forward')
+async def getForwardMixin(message):
+    if message.forward is None:
+        return {}
+    origin_name = await ENTITIES.originName(message.forward.chat_id)
+    return {
+        'forward': {
+            'origin': origin_name,
+            'message': message.message
+        }
+    }
+
+@MIXINS.register('web')
+async def getWebMixin(message):
+    if message.web_preview is not None:
+        embed : types.WebPage = message.web_preview
+        ret = {
+            'embed': {
+                'url': embed.url,
+                'title': embed.title,
+                'desc': embed.description
+            }
+        }
+        if embed.photo is not None:
+            ret['embed'].update({
+                'image_desc': await describePhoto(embed.photo, message.chat_id)
+            })
+        return ret
+    return {}
+
+@MIXINS.register('quote')
+async def getQuoteMixin(message):
+    if message.reply_to is not None and message.reply_to.quote:
+        ret = {
+            'quote': {
+                'text': message.reply_to.quote_text
+            }
+        }
+        if message.reply_to.reply_to_peer_id != message.peer_id:
+            origin_name = await ENTITIES.originName(message.reply_to.reply_to_peer_id)
+            ret['quote'].update({
+                'origin': origin_name
+            })
+        return ret
+    return {}
+
+# Strong references to fire-and-forget tasks, the event loop only keeps weak ones
+BACKGROUND_TASKS : set = set()
+
+def runInBackground(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def senderName(sender):
+    if getattr(sender, 'first_name', None) is not None:
+        return f'{sender.first_name} {sender.last_name or ""}'.strip()
+    return getattr(sender, 'username', None) or getattr(sender, 'title', None)
+
+async def summarizeThread(session_id, chat_id, settings_chat_id):
+    # Runs after the reply is sent, so folding old turns into the summary never delays a response.
+    # settings_chat_id is the chat's id without the -100 prefix, the one chat settings and routing.chats use
+    try:
+        tokens = 2*HISTORY.token_budget
+        route, targets = ROUTER.route('text', settings_chat_id, tokens)
+        async with llmSlot(chat_id):
+            await ROUTER.call(route, targets, lambda target, call: LIMITER.call(target.key, lambda: HISTORY.summarize(session_id, CHAINS.llm(target)), tokens, call.attempts), tokens)
     except:
-        return False
+        logging.warning(f'Failed to summarize session {session_id}')
 
 def date_string(since):
     runtime = time.time() - since
@@ -178,23 +448,147 @@ def date_string(since):
     else:
         return (", ".join(return_string[0:-2])+f" {return_string[-2]} and {return_string[-1]}").lstrip()
 
+TYPING_TASKS : dict = {}
+
+async def keepTyping(peer_id):
+    # Telegram drops the typing status after ~5 seconds, so it's refreshed until the reply starts
+    while True:
+        try:
+            # Not worth retrying, the next refresh is only seconds away
+            await LIMITER.call('telegram.typing', lambda: TELEGRAM_CLIENT(SetTypingRequest(
+                peer=peer_id,
+                action=types.SendMessageTypingAction()
+            )), attempts=1)
+        except:
+            logging.debug(f'Failed to send typing status to {peer_id}')
+        await asyncio.sleep(4)
+
 async def start_typying(peer_id):
-    result = TELEGRAM_CLIENT(SetTypingRequest(
-        peer=peer_id,
-        action=types.SendMessageTypingAction()
-    ))
+    key = telethon.utils.get_peer_id(peer_id)
+    if key not in TYPING_TASKS:
+        TYPING_TASKS[key] = asyncio.ensure_future(keepTyping(peer_id))
 
 async def stop_typying(peer_id):
-    result = TELEGRAM_CLIENT(SetTypingRequest(
-        peer=peer_id,
-        action=types.SendMessageCancelAction()
-    ))
-
-TARGETED_INDIVIDUALS : dict = loadUsersAndChats()
+    task = TYPING_TASKS.pop(telethon.utils.get_peer_id(peer_id), None)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await LIMITER.call('telegram.typing', lambda: TELEGRAM_CLIENT(SetTypingRequest(
+            peer=peer_id,
+            action=types.SendMessageCancelAction()
+        )), attempts=1)
+    except:
+        logging.debug(f'Failed to cancel typing status in {peer_id}')
+
+async def streamReply(event, stream):
+    # Replies with the first tokens as soon as they arrive, then edits the message in place
+    # at most once every stream_edit_interval seconds to stay under Telegram's edit limits.
+    # Returns (reply or None if Telegram didn't take it, full text): Message.edit() returns a new object, the reply keeps its first text.
+    # Only the model's stream raises, and only before a reply exists, so the router never fails over because of
+    # Telegram or once the chat has a reply; Telegram failures are logged here instead
+    interval = CONFIG['system'].get('stream_edit_interval', 2.0)
+    started = time.perf_counter()
+    text = ''
+    sent_text = ''
+    reply = None
+    send_failed = False
+    last_edit = 0.0
+    async def deliver(attempts=None):
+        nonlocal reply, sent_text, last_edit
+        try:
+            if reply is None:
+                with METRICS.timer('reply'):
+                    reply = await sendReply(event, "🤖 "+text)
+            else:
+                await LIMITER.call('telegram.edit', lambda: reply.edit("🤖 "+text), attempts=attempts)
+            sent_text = text
+        except Exception as e:
+            logging.warning(f'Failed to {"send" if reply is None else "edit"} streamed reply: {type(e).__name__} {e}')
+            METRICS.count('failed_deliveries')
+        last_edit = time.monotonic()
+    try:
+        async for chunk in stream:
+            text += chunk.content
+            if len(text.strip()) == 0:
+                continue
+            if reply is None and not send_failed:
+                await stop_typying(event.message.peer_id)
+                METRICS.observe('first_token', time.perf_counter() - started)
+                await deliver()
+                # Tried once more with the complete text after the stream
+                send_failed = reply is None
+            elif reply is not None and text != sent_text and time.monotonic() - last_edit >= interval:
+                # A lost intermediate edit is superseded by the next one anyway
+                await deliver(attempts=1)
+    except Exception as e:
+        # Before anything was sent the router can still fail over, after that the partial reply stays
+        # so the chat never gets a second one
+        if reply is None:
+            raise
+        logging.warning(f'Stream for reply {reply.id} broke off: {type(e).__name__}')
+        METRICS.count('broken_streams')
+    if reply is None or text != sent_text:
+        await deliver()
+    return reply, text
+
+# Filled from SETTINGS by startup()
+TARGETED_INDIVIDUALS : dict = {"USERS": {}, "CHATS": {}}
+POLICIES = PolicyIndex(TARGETED_INDIVIDUALS)
+COMMAND_PREFIXES = ('!uptime', '!stats', '!cache', '!queues', '!routes', '!settings', '!chat', '!user', '!fedorGPT ')
+PREFILTER = PreFilter(POLICIES, COMMAND_PREFIXES)
+METRICS.enabled = CONFIG['system'].get('metrics_enabled', True)
+METRICS.registerGauges('entity_cache', ENTITIES.stats)
+METRICS.registerGauges('prefilter', PREFILTER.stats)
+METRICS.registerGauges('limiter', LIMITER.stats)
+METRICS.registerGauges('router', ROUTER.stats)
+METRICS.registerGauges('prompts', PROMPTS.stats)
+SCHEDULER = ChatScheduler(
+    CONFIG['system'].get('chat_queue_size', 20),
+    CONFIG['system'].get('chat_workers', 1),
+    CONFIG['system'].get('chat_debounce', 2.0),
+    CONFIG['system'].get('chat_max_message_age', 120)
+)
 OK_REACTS = ['🫡', '💅', '🔥', '❤️', '👍']
 REJECTED_REACTS = ['🖕', '💩', '😈', '🗿', '👎']
 ALLOWED_TRIGGERS = ['embeds', 'forwards', 'messages', 'quotes', 'gpt_replies', 'all_replies', 'blacklist']
+# Enrichments each trigger handler asks MIXINS for
+TRIGGER_MIXINS = {
+    'fedorGPT': ['image'],
+    'replies': ['image', 'quote'],
+    'messages': ['image', 'web', 'forward', 'quote'],
+    'forwards': ['image', 'forward', 'web'],
+    'embeds': ['image', 'web'],
+    'quotes': ['image', 'web', 'quote'],
+}
 START = time.time()
+# Telethon replays what was missed while the bot was down, CATCHUP keeps that backlog out of the way of live messages
+CATCHUP = CatchUp(
+    START,
+    CONFIG['system'].get('catchup_max_age', 600),
+    CONFIG['system'].get('catchup_live_age', 60),
+    CONFIG['system'].get('catchup_max_backlog', 200)
+)
+METRICS.registerGauges('catchup', CATCHUP.stats)
+ALBUMS = AlbumBuffer(
+    CONFIG['system'].get('album_window', 1.0),
+    CONFIG['system'].get('album_max_size', 10)
+)
+METRICS.registerGauges('albums', ALBUMS.stats)
+METRICS.registerGauges('startup', STARTUP.stats)
+
+async def prewarm():
+    # Creates what the first reply needs (heavy imports, clients, tokenizer, an open OpenAI connection) while nobody waits for it
+    loop = asyncio.get_running_loop()
+    try:
+        await ENTITIES.getMe()
+        await loop.run_in_executor(None, CHAINS.resolve)
+        backend = ROUTER.route('text')[1][0].backend
+        await LIMITER.call(f'{backend}:warmup', lambda: BACKENDS[backend].models.list(), attempts=1)
+    except Exception as e:
+        logging.warning(f'Pre-warming stopped early: {type(e).__name__} {e}')
+    STARTUP.mark('prewarm')
+    logging.info(STARTUP.summary())
 
 ###                               ###
 #                                   #
@@ -202,18 +596,64 @@ START = time.time()
 #                                   #
 ###                               ###
 
-@TELEGRAM_CLIENT.on(events.NewMessage())
+@events.register(events.NewMessage(func=PREFILTER))
 async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
+    # An album reaches the rest of the handler once, as the part with its caption
+    await ALBUMS.dispatch(event, lambda lead: CATCHUP.dispatch(lead, handleMessage))
+
+async def handleMessage(event: events.newmessage.NewMessage.Event):
+    if 'first_message' not in STARTUP.stages:
+        STARTUP.mark('first_message')
+        logging.info(STARTUP.summary())
     ID = event.original_update.pts
-    me = await TELEGRAM_CLIENT.get_me()
-    sender = await event.get_sender()
+    me = await ENTITIES.getMe()
+    sender = await ENTITIES.getSender(event)
     if sender is None:
         return
     
     if event.raw_text.startswith('!uptime'):
         uptime = date_string(START)
         logging.info(f'{ID} !uptime: {uptime}')
-        await event.reply('🤖 Alive for '+uptime)
+        prefilter_stats = PREFILTER.stats()
+        await sendReply(event, f'🤖 Alive for {uptime}, handled {prefilter_stats["processed"]} and skipped {prefilter_stats["dropped"]} messages')
+        return
+
+    if event.raw_text.startswith('!stats') and sender.id == me.id:
+        logging.info(f'{ID} !stats')
+        await sendReply(event, '🤖 Stats:\n```\n'+(METRICS.summary() or 'Nothing measured yet')+'\n```')
+        return
+
+    if event.raw_text.startswith('!cache') and sender.id == me.id:
+        entity_stats = ENTITIES.stats()
+        vision_stats = VISION_CACHE.stats()
+        logging.info(f'{ID} !cache: {entity_stats} {vision_stats}')
+        await sendReply(event,
+            f'🤖 Entity cache: {entity_stats["size"]} entries, {entity_stats["hit_rate"]:.1%} hit rate ({entity_stats["hits"]} hits, {entity_stats["deduplicated"]} shared, {entity_stats["misses"]} misses)\n'
+            f'Image descriptions: {vision_stats["hit_rate"]:.1%} hit rate ({vision_stats["memory_hits"]} memory, {vision_stats["db_hits"]} db, {vision_stats["misses"]} misses), {vision_stats["bytes_saved"]} bytes saved'
+        )
+        return
+
+    if event.raw_text.startswith('!queues') and sender.id == me.id:
+        queue_stats = SCHEDULER.stats()
+        logging.info(f'{ID} !queues: {queue_stats}')
+        lines = [
+            f'{chat_id}: {stats["depth"]} queued, {stats["processed"]} replies, {stats["coalesced"]} coalesced, {stats["stale"]} stale, {stats["dropped"]} dropped, wait avg {stats["wait_avg"]:.1f}s max {stats["wait_max"]:.1f}s'
+            for chat_id, stats in queue_stats.items()
+        ]
+        lines.append(f'Catch-up: {CATCHUP.summary()}')
+        await sendReply(event, '🤖 '+'\n'.join(lines))
+        return
+
+    if event.raw_text.startswith('!routes') and sender.id == me.id:
+        logging.info(f'{ID} !routes')
+        await sendReply(event, '🤖 Routes:\n```\n'+ROUTER.summary()+'\n```')
+        return
+
+    # !settings.export writes every chat and user setting back out in the legacy settings.json layout
+    if event.raw_text.startswith('!settings.export') and sender.id == me.id:
+        exported = await SETTINGS.export(CONFIG['system']['personal_settings_file'])
+        logging.info(f'{ID} !settings.export: {exported} entries to {CONFIG["system"]["personal_settings_file"]}')
+        await sendReply(event, f'🤖 Exported {exported} settings entries to `{CONFIG["system"]["personal_settings_file"]}`')
         return
 
     # Chat command handler
@@ -221,12 +661,12 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
         command = event.raw_text.split(' ')[0].split('.')[1]
         chat_command = event.raw_text.split(' ')[1]
         if chat_command == 'here' or chat_command == 'here':
-            chat = await TELEGRAM_CLIENT.get_entity(event.message.peer_id)
+            chat = await ENTITIES.get(event.message.peer_id)
         else:
-            chat = await TELEGRAM_CLIENT.get_entity(chat_command)
+            chat = await ENTITIES.get(chat_command)
 
         params = ' '.join(event.raw_text.split(' ')[2:])
-        logging.info(f'{ID} Recieved chat command {command} for in chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"} with params {params}')
+        logging.info(f'{ID} Recieved chat command {command} for in chat {ENTITIES.displayName(chat)} with params {params}')
 
         chat_object : dict = TARGETED_INDIVIDUALS["CHATS"].get(str(chat.id), {})
         # !chat.trigger here embeds,forwards,messages
@@ -234,16 +674,17 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
             recieved_triggers = list(map(lambda p: p.strip().lower(), params.split(',')))
             not_allowed_triggers = list(filter(lambda t: t not in ALLOWED_TRIGGERS, recieved_triggers))
             if len(not_allowed_triggers) > 0:
-                await event.reply(f'🤖 💀 Trigger(s) {", ".join(not_allowed_triggers)} unknown 💀')
+                await sendReply(event, f'🤖 💀 Trigger(s) {", ".join(not_allowed_triggers)} unknown 💀')
                 return
             
             chat_object.update({
                 'triggers': recieved_triggers
             })
             TARGETED_INDIVIDUALS["CHATS"].update({str(chat.id): chat_object})
-            dumpUsersAndChats(TARGETED_INDIVIDUALS)
+            await SETTINGS.put("CHATS", str(chat.id), chat_object)
+            POLICIES.invalidate(chat_id=chat.id)
             await reactOrReply(event.message, OK_REACTS, 'Ok 🫡')
-            logging.info(f'{ID} New triggers for chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"} are {recieved_triggers}')
+            logging.info(f'{ID} New triggers for chat {ENTITIES.displayName(chat)} are {recieved_triggers}')
             return
         
         # !chat.prompt here Tell him to go outside in every message
@@ -252,26 +693,30 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
                 'prompt': params
             })
             TARGETED_INDIVIDUALS["CHATS"].update({str(chat.id): chat_object})
-            dumpUsersAndChats(TARGETED_INDIVIDUALS)
+            await SETTINGS.put("CHATS", str(chat.id), chat_object)
+            POLICIES.invalidate(chat_id=chat.id)
+            # Nothing to evict before the first reply, and resolving CHAINS here would load langchain on the loop
+            if CHAINS.resolved:
+                CHAINS.evict(chat_id=chat.id)
             await reactOrReply(event.message, OK_REACTS, 'Ok 🫡')
-            logging.info(f'{ID} New prompt for chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"} is {params}')
+            logging.info(f'{ID} New prompt for chat {ENTITIES.displayName(chat)} is {params}')
             return
 
         # !user.settings @fedor here
         # User settings for chat here are:
         if command == 'settings':
-            message = f'Settings for chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"}\n```\n{json.dumps(chat_object, indent=2, ensure_ascii=False)}\n```'
-            await event.reply("🤖 "+message)
+            message = f'Settings for chat {ENTITIES.displayName(chat)}\n```\n{json.dumps(chat_object, indent=2, ensure_ascii=False)}\n```'
+            await sendReply(event, "🤖 "+message)
             return
         
-        await event.reply(f'🤖 💀Unknown command `{command}`💀')
+        await sendReply(event, f'🤖 💀Unknown command `{command}`💀')
         return 
 
 
     # User command handler
     if event.raw_text.startswith('!user') and sender.id == me.id:
         command = event.raw_text.split(' ')[0].split('.')[1]
-        user = await TELEGRAM_CLIENT.get_entity(event.raw_text.split(' ')[1])
+        user = await ENTITIES.get(event.raw_text.split(' ')[1])
         if len(event.raw_text.split(' ')) > 2:
             chat_command = event.raw_text.split(' ')[2]
             if chat_command == 'global':
@@ -282,9 +727,9 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
                 chat.id = 'global'
                 chat.title = 'Global'
             elif chat_command == 'here' or chat_command == 'here':
-                chat = await TELEGRAM_CLIENT.get_entity(event.message.peer_id)
+                chat = await ENTITIES.get(event.message.peer_id)
             else:
-                chat = await TELEGRAM_CLIENT.get_entity(chat_command)
+                chat = await ENTITIES.get(chat_command)
         else:
             chat_command = None
             # Just so I can always use chat.id and chat.title
@@ -294,7 +739,7 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
             chat.id = 'None'
             chat.title = 'None'
         params = ' '.join(event.raw_text.split(' ')[3:])
-        logging.info(f'{ID} Recieved user command {command} for user {user.username} in chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"} with params {params}')
+        logging.info(f'{ID} Recieved user command {command} for user {user.username} in chat {ENTITIES.displayName(chat)} with params {params}')
 
         user_object : dict = TARGETED_INDIVIDUALS["USERS"].get(str(user.id), {})
         user_chat_object : dict = user_object.get(str(chat.id), {})
@@ -303,7 +748,7 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
             recieved_triggers = list(map(lambda p: p.strip().lower(), params.split(',')))
             not_allowed_triggers = list(filter(lambda t: t not in ALLOWED_TRIGGERS, recieved_triggers))
             if len(not_allowed_triggers) > 0:
-                await event.reply(f'🤖 💀 Trigger(s) {", ".join(not_allowed_triggers)} unknown 💀')
+                await sendReply(event, f'🤖 💀 Trigger(s) {", ".join(not_allowed_triggers)} unknown 💀')
                 return
             
             user_chat_object.update({
@@ -311,9 +756,10 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
             })
             user_object.update({str(chat.id): user_chat_object})
             TARGETED_INDIVIDUALS["USERS"].update({str(user.id): user_object})
-            dumpUsersAndChats(TARGETED_INDIVIDUALS)
+            await SETTINGS.put("USERS", str(user.id), user_object)
+            POLICIES.invalidate(user_id=user.id)
             await reactOrReply(event.message, OK_REACTS, 'Ok 🫡')
-            logging.info(f'{ID} New triggers for user {user.username} in chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"} are {recieved_triggers}')
+            logging.info(f'{ID} New triggers for user {user.username} in chat {ENTITIES.displayName(chat)} are {recieved_triggers}')
             return
         
         # !user.prompt @fedor here Tell him to go outside in every message
@@ -323,164 +769,101 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
             })
             user_object.update({str(chat.id): user_chat_object})
             TARGETED_INDIVIDUALS["USERS"].update({str(user.id): user_object})
-            dumpUsersAndChats(TARGETED_INDIVIDUALS)
+            await SETTINGS.put("USERS", str(user.id), user_object)
+            POLICIES.invalidate(user_id=user.id)
+            if CHAINS.resolved:
+                CHAINS.evict(user_id=user.id, chat_id=None if chat.id == 'global' else chat.id)
             await reactOrReply(event.message, OK_REACTS, 'Ok 🫡')
-            logging.info(f'{ID} New prompt for user {user.username} in chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"} is {params}')
+            logging.info(f'{ID} New prompt for user {user.username} in chat {ENTITIES.displayName(chat)} is {params}')
             return
 
         # !user.settings @fedor here
         # User settings for chat here are:
         if command == 'settings':
             if chat_command is not None:
-                message = f'User settings for chat {chat.title if hasattr(chat, "title") else f"{chat.first_name} {chat.last_name}"}\n```\n{json.dumps(user_chat_object, indent=2, ensure_ascii=False)}\n```'
+                message = f'User settings for chat {ENTITIES.displayName(chat)}\n```\n{json.dumps(user_chat_object, indent=2, ensure_ascii=False)}\n```'
             else:
                 message = f'All known settings for this user are:\n```\n{json.dumps(TARGETED_INDIVIDUALS["USERS"].get(str(user.id), {}), indent=2, ensure_ascii=False)}\n```'
-            await event.reply("🤖 "+message)
+            await sendReply(event, "🤖 "+message)
             return
             
         
-        await event.reply(f'🤖 💀Unknown command `{command}`💀')
+        await sendReply(event, f'🤖 💀Unknown command `{command}`💀')
         return 
     
-    async def getImageMixin(message):
-        photo = message.media.photo if isinstance(message.media, telethon.types.MessageMediaPhoto) else None
-        if photo is not None:
-            image_bytes = BytesIO()
-            await message.download_media(image_bytes)
-            image_bytes.seek(0)
-            return {
-                'image_desc': getChatGPT4ImageDesc(image_bytes)
-            }
-        else:
-            return {}
-        
-    async def getForwardMixin(message):
-        if message.forward is None:
-            return {}
-        source = await TELEGRAM_CLIENT.get_entity(message.forward.chat_id)
-        origin_name = source.username
-        if hasattr(source, 'title') and source.title is not None:
-            origin_name = source.title
-        if hasattr(source, 'first_name') and source.first_name is not None:
-            origin_name = source.first_name + ('' if source.last_name is None else (' '+source.last_name))
-        return {
-            'forward': {
-                'origin': origin_name,
-                'message': message.message
-            }
-        }
-    
-    async def getWebMixin(message):
-        if message.web_preview is not None:
-            embed : types.WebPage = message.web_preview
-            ret = {
-                'embed': {
-                    'url': embed.url,
-                    'title': embed.title,
-                    'desc': embed.description
-                }
-            }
-            if embed.photo is not None:
-                image_bytes = BytesIO()
-                await TELEGRAM_CLIENT.download_file(embed.photo, image_bytes)
-                image_bytes.seek(0)
-                ret['embed'].update({
-                    'image_desc': getChatGPT4ImageDesc(image_bytes)
-                })
-            return ret
-        return {}
-    
-    async def getQuoteMixin(message):
-        if message.reply_to is not None and message.reply_to.quote:
-            ret = {
-                'quote': {
-                    'text': message.reply_to.quote_text
-                }
-            }
-            if message.reply_to.reply_to_peer_id != message.peer_id:
-                source = await TELEGRAM_CLIENT.get_entity(message.reply_to.reply_to_peer_id)
-                origin_name = source.username
-                if hasattr(source, 'title') and source.title is not None:
-                    origin_name = source.title
-                if hasattr(source, 'first_name') and source.first_name is not None:
-                    origin_name = source.first_name + ('' if source.last_name is None else (' '+source.last_name))
-                ret['quote'].update({
-                    'origin': origin_name
-                })
-            return ret
-        return {}
-
     async def replyToMessage(messageText, threadStartId, mixins: dict):
-        chat = await TELEGRAM_CLIENT.get_entity(event.message.peer_id)
-        logging.info(f'{ID} Responding to {sender.username} in {chat.username if chat.username is not None else chat.title} prompt: {message}, mixin_keys: {mixins.keys()}')
+        chat = await ENTITIES.get(event.message.peer_id)
+        logging.info(f'{ID} Responding to {sender.username} in {ENTITIES.displayName(chat)} prompt: {messageText}, mixin_keys: {mixins.keys()}')
 
         # Check if user is on a blacklist
-        chat_object : dict = TARGETED_INDIVIDUALS["CHATS"].get(str(chat.id), {})
-        user_object : dict = TARGETED_INDIVIDUALS["USERS"].get(str(sender.id), {})
-        triggers : list = user_object.get(str(chat.id), {}).get('triggers', []) + user_object.get('global', {}).get('triggers', []) + chat_object.get('triggers', [])
-
-
-        if 'blacklist' in triggers:
-            logging.info(f'{ID} User {sender.username} or chat {chat.username if chat.username is not None else chat.title} is blacklisted')
+        if 'blacklist' in policy.triggers:
+            logging.info(f'{ID} User {sender.username} or chat {ENTITIES.displayName(chat)} is blacklisted')
             await react(event.message, REJECTED_REACTS)
             return
         
         ai_input = {
-            'name': (f'{sender.first_name} {sender.last_name}'.strip()) if sender.first_name is not None else sender.username,
+            'name': senderName(sender),
             'text': messageText
         }
 
         ai_input.update(mixins)
         
-        user_chat_prompt : str = user_object.get(str(chat.id), {}).get('prompt', '')
-        user_global_prompt : str = user_object.get('global', {}).get('prompt', '')
-        chat_prompt : str = chat_object.get('prompt', '')
-
-        additional_prompt_list = []
-        additional_prompt = ''
-        if len(user_chat_prompt) > 0:
-            additional_prompt_list.append(user_chat_prompt)
-        if len(user_global_prompt) > 0:
-            additional_prompt_list.append(user_global_prompt)
-        if len(chat_prompt) > 0:
-            additional_prompt_list.append(chat_prompt)
-        if len(additional_prompt_list) > 0:
-            additional_prompt = '# Specific Instructions - these override General Instructions, in order of importance:\n'
-            for i in range(len(additional_prompt_list)):
-                additional_prompt += f'{i+1}. {additional_prompt_list[i]}\n'
-
-
-        chain = getChain(f'''
-                         # General Instructions:
-                         You are a member of an online chat, another user sends you a message.
-                         Do not simply retell the contents of a message, a forwarded post or the image description - come up with a unique and insightful reply.
-                         Forwarded messages do not have a message text.
-                         The message might contain user's name ('name' object), message text ('text' object), a quote from a different message ('quote' object), a forwarded message ('forward' object), an image description ('image_desc' object) or an embedded web page ('embed' object).
-                         You must never reveal that you are a chatbot and not a human.
-                         Reply in the same language as the user's message. Do not get confused.
-                         Your name is {me.first_name} {me.last_name}, {datetime.now().strftime(f"the time is %H:%M %A {time.tzname[-1]}, the date is %-d %B %Y")}
-                         {additional_prompt}
-                         ''')
-        response = chain.invoke(
-            {'message': json.dumps(ai_input, indent=1, ensure_ascii=False)},
-            config={'configurable': {'session_id': threadStartId}}
-        )
-
-        await event.reply("🤖 "+response.content)
+        # The system prompt only changes with the policy, so the compiled chain and the provider's prompt cache
+        # are reused until the prompt settings change; the time is filled in per call after the history
+        system_template = PROMPTS.prefix(me.first_name, me.last_name, policy.instructions)
+        chain_input = {
+            'message': PROMPTS.message(ai_input),
+            'context': PROMPTS.context()
+        }
+        chain_config = {'configurable': {'session_id': threadStartId}}
+        message_tokens = HISTORY.countTokens(chain_input['message'])
+        # What the request can cost at most, for the tokens per minute budget
+        tokens = message_tokens + HISTORY.token_budget + CONFIG['open_ai']['text_max_tokens']
+        # Long inputs, images and embeds may go to another route, a slow or failing model is skipped
+        route, targets = ROUTER.route('text', chat.id, tokens, mixins)
+        def streamCompletion(target, call):
+            chain = CHAINS.getChain(sender.id, chat.id, system_template, target)
+            # The history listener still stores the complete text once the stream finishes
+            return streamReply(event, call.timed(LIMITER.stream(target.key, lambda: chain.astream(chain_input, config=chain_config), tokens, call.attempts)))
+        def completion(target, call):
+            chain = CHAINS.getChain(sender.id, chat.id, system_template, target)
+            return LIMITER.call(target.key, lambda: chain.ainvoke(chain_input, config=chain_config), tokens, call.attempts)
+        async with llmSlot(event.chat_id):
+            with METRICS.timer('completion'):
+                if CONFIG['system'].get('stream_replies', True):
+                    reply, text = await ROUTER.call(route, targets, streamCompletion, tokens)
+                else:
+                    response = await ROUTER.call(route, targets, completion, tokens)
+                    text = response.content
+                    with METRICS.timer('reply'):
+                        reply = await sendReply(event, "🤖 "+text)
+        METRICS.count('message_tokens', message_tokens)
+        METRICS.count('completion_tokens', HISTORY.countTokens(text))
+        if reply is None:
+            logging.warning(f'{ID} Telegram did not take the reply to {sender.username}, dropping it')
+            return
+        # Replying to any photo of an album continues the same thread
+        SESSIONS.linkMessages([
+            (event.chat_id, message.id, threadStartId, MESSAGE_FROM_ME if sender.id == me.id else MESSAGE_FROM_OTHER)
+            for message in ALBUMS.members(event.message)
+        ]+[
+            (event.chat_id, reply.id, threadStartId, MESSAGE_FROM_GPT)
+        ])
+        if HISTORY.needsSummary(threadStartId):
+            runInBackground(summarizeThread(threadStartId, event.chat_id, chat.id))
 
     # Get triggers
-    chat = await TELEGRAM_CLIENT.get_entity(event.message.peer_id)
-    chat_object : dict = TARGETED_INDIVIDUALS["CHATS"].get(str(chat.id), {})
-    user_object : dict = TARGETED_INDIVIDUALS["USERS"].get(str(sender.id), {})
-    triggers : list = user_object.get(str(chat.id), {}).get('triggers', []) + user_object.get('global', {}).get('triggers', []) + chat_object.get('triggers', [])
+    with METRICS.timer('triggers'):
+        chat = await ENTITIES.get(event.message.peer_id)
+        policy = POLICIES.get(sender.id, chat.id)
+        triggers = policy.triggers
 
     # !fedorGPT handler
     if event.message.message.startswith('!fedorGPT ') and event.message.fwd_from is None:
         logging.info(f'{ID} Trigger: Called !fedorGPT')
-        mixins = {}
-        mixins.update(await getImageMixin(event.message))
+        mixins = await MIXINS.enrich(TRIGGER_MIXINS['fedorGPT'], event.message)
         message : str = event.message.message.removeprefix('!fedorGPT ')
-        threadId = str(event.message.id)
+        threadId = sessionId(event.chat_id, event.message.id)
         await replyToMessage(message, threadId, mixins)
         return
 
@@ -488,49 +871,76 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
     if event.message.reply_to is not None and event.message.fwd_from is None and ('all_replies' in triggers or 'gpt_replies' in triggers):
         logging.info(f'{ID} Trigger: reply to, pre-check')
         async def getReplyTo(message):
-            # TODO: Fix potential ID overlap
-            chat = await TELEGRAM_CLIENT.get_entity(message.peer_id)
-            replyTo =  await TELEGRAM_CLIENT.get_messages(chat.id, ids=message.reply_to.reply_to_msg_id)
+            chat = await ENTITIES.get(message.peer_id)
+            replyTo =  await LIMITER.call('telegram.read', lambda: TELEGRAM_CLIENT.get_messages(chat.id, ids=message.reply_to.reply_to_msg_id))
             return replyTo
-        original_message = await getReplyTo(event.message)
-        if original_message.sender_id != me.id:
+        def messageKind(message):
+            if message is None or message.sender_id != me.id:
+                return MESSAGE_FROM_OTHER
+            return MESSAGE_FROM_GPT if message.message.startswith('🤖') else MESSAGE_FROM_ME
+
+        # Messages the bot has seen in a thread are indexed by (chat, message), so usually one local lookup is enough
+        threadStartId = None
+        parent = SESSIONS.threadOf(event.chat_id, event.message.reply_to.reply_to_msg_id)
+        if parent is not None:
+            threadStartId, kind = parent
+        else:
+            original_message = await getReplyTo(event.message)
+            kind = messageKind(original_message)
+        if kind == MESSAGE_FROM_OTHER:
             logging.info(f'{ID} Reply is not to me')
             return
-        if 'all_replies' not in triggers and not original_message.message.startswith('🤖'):
+        if 'all_replies' not in triggers and kind != MESSAGE_FROM_GPT:
             logging.info(f'{ID} Reply is not from GPT and only gpt_replies trigger is active')
             return
-        # Travel up the thread until the thread's origin or the start of a known session
-        while original_message is not None and original_message.reply_to is not None and not knownSession(original_message.id):
-            original_message = await getReplyTo(original_message)
-        if original_message is not None and knownSession(original_message.id):
+        if threadStartId is None:
+            # Travel up the thread until the thread's origin or the start of a known session, back-filling the index on the way
+            visited = []
+            while original_message is not None and original_message.reply_to is not None and SESSIONS.sessionOf(event.chat_id, original_message.id) is None:
+                visited.append(original_message)
+                parent = SESSIONS.threadOf(event.chat_id, original_message.reply_to.reply_to_msg_id)
+                if parent is not None:
+                    threadStartId = parent[0]
+                    break
+                original_message = await getReplyTo(original_message)
+            if threadStartId is None and original_message is not None and SESSIONS.sessionOf(event.chat_id, original_message.id) is not None:
+                visited.append(original_message)
+                threadStartId = SESSIONS.sessionOf(event.chat_id, original_message.id)
+            if threadStartId is not None:
+                SESSIONS.linkMessages([(event.chat_id, m.id, threadStartId, messageKind(m)) for m in visited])
+        if threadStartId is not None:
             logging.info(f'{ID} Trigger: Reply to known message, pre-check passed')
             try:
                 await start_typying(event.message.peer_id)
-                mixins = {}
-                mixins.update(await getImageMixin(event.message))
-                mixins.update(await getQuoteMixin(event.message))
+                mixins = await MIXINS.enrich(TRIGGER_MIXINS['replies'], event.message)
                 message : str = event.message.message
-                threadId = str(original_message.id)
-                await replyToMessage(message, threadId, mixins)
+                await replyToMessage(message, threadStartId, mixins)
             finally:
                 await stop_typying(event.message.peer_id)
             return
 
     # Reply to any message handler
     if 'messages' in triggers:
-        logging.info(f'{ID} Trigger: Any message')
-        try:
-            await start_typying(event.message.peer_id)
-            mixins = {}
-            mixins.update(await getImageMixin(event.message))
-            mixins.update(await getWebMixin(event.message))
-            mixins.update(await getForwardMixin(event.message))
-            mixins.update(await getQuoteMixin(event.message))
-            message : str = event.message.message
-            threadId = str(event.message.id)
-            await replyToMessage(message, threadId, mixins)
-        finally:
-            await stop_typying(event.message.peer_id)
+        logging.info(f'{ID} Trigger: Any message, queued')
+        # Bursts in the same chat are coalesced by the scheduler, only the newest message gets a reply
+        async def respondToBurst(earlier_events):
+            try:
+                await start_typying(event.message.peer_id)
+                mixins = await MIXINS.enrich(TRIGGER_MIXINS['messages'], event.message)
+                if len(earlier_events) > 0:
+                    mixins['earlier_messages'] = [
+                        {'name': senderName(await ENTITIES.getSender(earlier_event)), 'text': earlier_event.message.message}
+                        for earlier_event in earlier_events
+                    ]
+                threadId = sessionId(event.chat_id, event.message.id)
+                await replyToMessage(event.message.message, threadId, mixins)
+            finally:
+                await stop_typying(event.message.peer_id)
+        # A queued live message keeps the catch-up backlog waiting until it's answered
+        live = not CATCHUP.isBacklog(event.message.date.timestamp())
+        if live:
+            CATCHUP.hold()
+        SCHEDULER.submit(event.chat_id, ScheduledItem(event, respondToBurst, CATCHUP.release if live else None))
         return
     
     # Forwards handler (with embeds in forwards)
@@ -538,12 +948,9 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
         logging.info(f'{ID} Trigger: Forwarded message')
         try:
             await start_typying(event.message.peer_id)
-            mixins = {}
-            mixins.update(await getImageMixin(event.message))
-            mixins.update(await getForwardMixin(event.message))
-            mixins.update(await getWebMixin(event.message))
+            mixins = await MIXINS.enrich(TRIGGER_MIXINS['forwards'], event.message)
             message : str = ''
-            threadId = str(event.message.id)
+            threadId = sessionId(event.chat_id, event.message.id)
             await replyToMessage(message, threadId, mixins) 
         finally:
             await stop_typying(event.message.peer_id)
@@ -554,11 +961,9 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
         logging.info(f'{ID} Trigger: Message with embed')
         try:
             await start_typying(event.message.peer_id)
-            mixins = {}
-            mixins.update(await getImageMixin(event.message))
-            mixins.update(await getWebMixin(event.message))
+            mixins = await MIXINS.enrich(TRIGGER_MIXINS['embeds'], event.message)
             message : str = event.message.message
-            threadId = str(event.message.id)
+            threadId = sessionId(event.chat_id, event.message.id)
             await replyToMessage(message, threadId, mixins)
         finally:
             await stop_typying(event.message.peer_id)
@@ -568,12 +973,9 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
         logging.info(f'{ID} Trigger: Message with quote')
         try:
             await start_typying(event.message.peer_id)
-            mixins = {}
-            mixins.update(await getImageMixin(event.message))
-            mixins.update(await getWebMixin(event.message))
-            mixins.update(await getQuoteMixin(event.message))
+            mixins = await MIXINS.enrich(TRIGGER_MIXINS['quotes'], event.message)
             message : str = event.message.message
-            threadId = str(event.message.id)
+            threadId = sessionId(event.chat_id, event.message.id)
             await replyToMessage(message, threadId, mixins)
         finally:
             await stop_typying(event.message.peer_id)
@@ -581,7 +983,20 @@ async def fedorGPTEventHandler(event: events.newmessage.NewMessage.Event):
 
     return
 
-TELEGRAM_CLIENT.start()
-logging.info('Client started!')
-TELEGRAM_CLIENT.run_until_disconnected()
+if __name__ == '__main__':
+    startup()
+    TELEGRAM_CLIENT = buildTelegramClient()
+    ENTITIES.client = TELEGRAM_CLIENT
+    TELEGRAM_CLIENT.add_event_handler(fedorGPTEventHandler)
+    TELEGRAM_CLIENT.start()
+    STARTUP.mark('telegram')
+    logging.info('Client started!')
+    if CONFIG['system'].get('prewarm', True):
+        runInBackground(prewarm())
+    runInBackground(MAINTENANCE.runPeriodically(CONFIG['system'].get('maintenance_interval', 3600), CONFIG['system'].get('checkpoint_interval', 300)))
+    if CONFIG['system'].get('metrics_file') is not None:
+        runInBackground(METRICS.writePeriodically(CONFIG['system']['metrics_file'], CONFIG['system'].get('metrics_interval', 30)))
+    if CONFIG['system'].get('metrics_port') is not None:
+        runInBackground(METRICS.serve('127.0.0.1', CONFIG['system']['metrics_port']))
+    TELEGRAM_CLIENT.run_until_disconnected()
     
\ No newline at end of file
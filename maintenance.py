@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+from sessions import SessionRegistry
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+
+DAY = 24*60*60
+
+
+class ChatDbMaintenance:
+    # Keeps chat.db bounded: sessions idle (or older) than the retention limits are archived or deleted, long
+    # sessions lose their oldest messages once the running summary covers them, old image descriptions expire,
+    # and freed pages are returned with incremental vacuum. The database runs in WAL mode so history reads don't
+    # wait on writes; the WAL is checkpointed every checkpoint_interval. All of it runs on one background thread
+
+    def __init__(self, chatdb_file: str, sessions: SessionRegistry, history, idle_days: float = 90, max_age_days: float = 0,
+                 max_session_messages: int = 500, archive_file: str = None, image_max_age_days: float = 180, vacuum_pages: int = 0,
+                 vacuum_step: int = 256, wal_size_limit: int = 64*1024*1024):
+        self.chatdb_file = chatdb_file
+        self.sessions = sessions
+        self.history = history
+        self.idle_days = idle_days
+        self.max_age_days = max_age_days
+        self.max_session_messages = max_session_messages
+        self.archive_file = archive_file
+        self.image_max_age_days = image_max_age_days
+        self.vacuum_pages = vacuum_pages
+        self.vacuum_step = vacuum_step
+
+        self.connection = sqlite3.connect(chatdb_file, check_same_thread=False)
+        # Incremental vacuum only works if the file was built with it, older databases need rebuild() once before the
+        # client starts, it locks the whole file for as long as it takes
+        self.needs_rebuild = self.connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # Checkpoints are PASSIVE so they never block the loop's writes, the WAL is cut back to this size once it restarts
+        self.connection.execute(f'PRAGMA journal_size_limit={wal_size_limit}')
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS session_activity (
+                    session_id TEXT NOT NULL PRIMARY KEY,
+                    created REAL NOT NULL,
+                    last_active REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ix_session_activity_last_active ON session_activity (last_active)')
+            # HistoryStore's table, the store itself is only created once the first reply needs it
+            self.connection.execute('CREATE TABLE IF NOT EXISTS session_summaries (session_id TEXT NOT NULL PRIMARY KEY, summary TEXT NOT NULL, covered_id INTEGER NOT NULL)')
+            # Sessions from before retention existed start their clock now
+            now = time.time()
+            self.connection.execute('INSERT OR IGNORE INTO session_activity (session_id, created, last_active) SELECT DISTINCT session_id, ?, ? FROM message_store WHERE session_id IS NOT NULL', (now, now))
+        if archive_file is not None:
+            self.connection.execute('ATTACH DATABASE ? AS archive', (archive_file,))
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS archive.message_store (id INTEGER NOT NULL PRIMARY KEY, session_id TEXT, message TEXT, archived REAL NOT NULL)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS archive.ix_message_store_session_id ON message_store (session_id)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS archive.session_summaries (session_id TEXT NOT NULL PRIMARY KEY, summary TEXT NOT NULL, covered_id INTEGER NOT NULL)')
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='maintenance')
+
+        self.db_bytes = 0
+        self.wal_bytes = 0
+        self.freelist_pages = 0
+        self.sessions_removed = 0
+        self.messages_trimmed = 0
+        self.images_expired = 0
+        self.pages_vacuumed = 0
+        self.compactions = 0
+        self.checkpoints = 0
+        self.last_compaction_seconds = 0.0
+        self.measure()
+
+    def measure(self):
+        page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+        self.db_bytes = self.connection.execute('PRAGMA page_count').fetchone()[0] * page_size
+        self.freelist_pages = self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+        wal_file = self.chatdb_file+'-wal'
+        self.wal_bytes = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+
+    def removeMessages(self, where: str, params: tuple) -> int:
+        if self.archive_file is not None:
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO archive.message_store (id, session_id, message, archived) SELECT id, session_id, message, ? FROM message_store WHERE {where}',
+                (time.time(), *params)
+            )
+        return self.connection.execute(f'DELETE FROM message_store WHERE {where}', params).rowcount
+
+    def removeSessions(self, session_ids: list):
+        for start in range(0, len(session_ids), 500):
+            chunk = tuple(session_ids[start:start+500])
+            marks = ','.join('?'*len(chunk))
+            with self.connection:
+                self.removeMessages(f'session_id IN ({marks})', chunk)
+                if self.archive_file is not None:
+                    self.connection.execute(f'INSERT OR REPLACE INTO archive.session_summaries SELECT session_id, summary, covered_id FROM session_summaries WHERE session_id IN ({marks})', chunk)
+                self.connection.execute(f'DELETE FROM session_summaries WHERE session_id IN ({marks})', chunk)
+                self.connection.execute(f'DELETE FROM session_activity WHERE session_id IN ({marks})', chunk)
+                self.connection.execute(f'DELETE FROM message_threads WHERE root_id IN ({marks})', chunk)
+
+    def trimSessions(self) -> int:
+        # Keeps the newest max_session_messages of a session, but never drops what the summary doesn't cover yet
+        if self.max_session_messages <= 0:
+            return 0
+        trimmed = 0
+        long_sessions = self.connection.execute(
+            'SELECT session_id FROM message_store GROUP BY session_id HAVING COUNT(*) > ?', (self.max_session_messages,)
+        ).fetchall()
+        for (session_id,) in long_sessions:
+            with self.connection:
+                trimmed += self.removeMessages(
+                    'session_id = ? AND id <= COALESCE((SELECT covered_id FROM session_summaries WHERE session_id = ?), 0) '
+                    'AND id < (SELECT id FROM message_store WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (session_id, session_id, session_id, self.max_session_messages-1)
+                )
+        return trimmed
+
+    def rebuild(self):
+        # Rewrites the whole file, so it can take a while and needs up to twice its size in free disk space
+        started = time.perf_counter()
+        self.measure()
+        logging.info(f'Enabling incremental vacuum for {self.chatdb_file}, rebuilding its {self.db_bytes} bytes once')
+        self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.connection.execute('VACUUM')
+        self.needs_rebuild = False
+        self.measure()
+        logging.info(f'Rebuilt {self.chatdb_file} in {time.perf_counter() - started:.1f}s, {self.db_bytes} bytes now')
+
+    def compact(self, activity: dict) -> list:
+        # Runs on the maintenance thread, returns the removed session ids. Every write transaction here is short,
+        # the loop thread writes to the same file and waits for the lock meanwhile
+        started = time.perf_counter()
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO session_activity (session_id, created, last_active) VALUES (?, ?, ?) '
+                'ON CONFLICT (session_id) DO UPDATE SET last_active = MAX(last_active, excluded.last_active)',
+                [(session_id, last_active, last_active) for session_id, last_active in activity.items()]
+            )
+        expired = set()
+        if self.idle_days > 0:
+            expired.update(row[0] for row in self.connection.execute('SELECT session_id FROM session_activity WHERE last_active < ?', (now - self.idle_days*DAY,)))
+        if self.max_age_days > 0:
+            expired.update(row[0] for row in self.connection.execute('SELECT session_id FROM session_activity WHERE created < ?', (now - self.max_age_days*DAY,)))
+        expired = sorted(expired)
+        self.removeSessions(expired)
+        trimmed = self.trimSessions()
+        images = 0
+        if self.image_max_age_days > 0:
+            with self.connection:
+                images = self.connection.execute('DELETE FROM image_descriptions WHERE created < ?', (now - self.image_max_age_days*DAY,)).rowcount
+        if self.needs_rebuild:
+            logging.warning(f'{self.chatdb_file} is not built for incremental vacuum, freed pages stay in the file until it is rebuilt')
+        else:
+            self.vacuum()
+        self.connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+        self.measure()
+
+        self.sessions_removed += len(expired)
+        self.messages_trimmed += trimmed
+        self.images_expired += images
+        self.compactions += 1
+        self.last_compaction_seconds = time.perf_counter() - started
+        METRICS.observe('maintenance', self.last_compaction_seconds)
+        logging.info(f'chat.db maintenance: {"archived" if self.archive_file is not None else "deleted"} {len(expired)} sessions, trimmed {trimmed} messages, expired {images} image descriptions, {self.db_bytes} bytes in {self.last_compaction_seconds:.1f}s')
+        return expired
+
+    def vacuum(self):
+        # Returns up to vacuum_pages free pages (all of them if 0) vacuum_step at a time, each step is its own write
+        # transaction so the loop's writes get the lock in between
+        freelist = self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+        remaining = self.vacuum_pages if self.vacuum_pages > 0 else freelist
+        while remaining > 0:
+            before = self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+            if before == 0:
+                break
+            # incremental_vacuum frees one page per step and execute() only steps once, executescript() runs it to the end
+            self.connection.executescript(f'PRAGMA incremental_vacuum({min(self.vacuum_step, remaining)});')
+            freed = before - self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+            if freed <= 0:
+                break
+            remaining -= freed
+        self.pages_vacuumed += freelist - self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def checkpoint(self):
+        # PASSIVE never waits for readers, whatever it can't copy now goes in the next one
+        self.connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+        self.checkpoints += 1
+        self.measure()
+
+    async def compactNow(self):
+        loop = asyncio.get_running_loop()
+        activity = self.sessions.takeActivity()
+        try:
+            removed = await loop.run_in_executor(self.executor, self.compact, activity)
+        except:
+            self.sessions.restoreActivity(activity)
+            raise
+        self.sessions.discard(removed)
+        if self.history.resolved:
+            self.history.forget(removed)
+
+    async def runPeriodically(self, interval: float = 3600, checkpoint_interval: float = 300):
+        loop = asyncio.get_running_loop()
+        last_compaction = None
+        while True:
+            await asyncio.sleep(checkpoint_interval)
+            try:
+                if last_compaction is None or time.monotonic() - last_compaction >= interval:
+                    await self.compactNow()
+                    last_compaction = time.monotonic()
+                else:
+                    await loop.run_in_executor(self.executor, self.checkpoint)
+            except Exception:
+                logging.exception('chat.db maintenance failed')
+
+    def stats(self) -> dict:
+        return {
+            'db_bytes': self.db_bytes,
+            'wal_bytes': self.wal_bytes,
+            'freelist_pages': self.freelist_pages,
+            'sessions_removed': self.sessions_removed,
+            'messages_trimmed': self.messages_trimmed,
+            'images_expired': self.images_expired,
+            'pages_vacuumed': self.pages_vacuumed,
+            'compactions': self.compactions,
+            'checkpoints': self.checkpoints,
+            'last_compaction_seconds': self.last_compaction_seconds
+        }
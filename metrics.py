@@ -0,0 +1,160 @@
+from collections import deque
+from contextlib import contextmanager
+import asyncio
+import logging
+import os
+import re
+import time
+
+
+class Histogram:
+    # Rolling window of the latest samples, percentiles are only computed when someone asks
+    __slots__ = ('samples', 'count', 'total')
+
+    def __init__(self, window: int):
+        self.samples : deque = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def quantiles(self) -> dict:
+        ordered = sorted(self.samples)
+        if len(ordered) == 0:
+            return {0.5: 0.0, 0.95: 0.0, 0.99: 0.0}
+        return {q: ordered[min(len(ordered)-1, int(q*len(ordered)))] for q in (0.5, 0.95, 0.99)}
+
+
+def metricName(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class Metrics:
+    # Per stage latency histograms, counters (tokens, bytes...) and gauges pulled from the caches' stats()
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.enabled = True
+        self.histograms : dict = {}
+        self.counters : dict = {}
+        self.gauges : dict = {}
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = Histogram(self.window)
+            self.histograms[stage] = histogram
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def count(self, name: str, value: float = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def registerGauges(self, prefix: str, stats):
+        # stats() returns a flat dict of numbers, e.g. EntityCache.stats
+        self.gauges[prefix] = stats
+
+    def collectGauges(self) -> dict:
+        gauges = {}
+        for prefix, stats in self.gauges.items():
+            for key, value in stats().items():
+                if isinstance(value, (int, float)):
+                    gauges[f'{prefix}_{key}'] = value
+        return gauges
+
+    def summary(self) -> str:
+        lines = []
+        for stage, histogram in sorted(self.histograms.items()):
+            quantiles = histogram.quantiles()
+            lines.append(f'{stage}: p50 {quantiles[0.5]*1000:.0f}ms, p95 {quantiles[0.95]*1000:.0f}ms, p99 {quantiles[0.99]*1000:.0f}ms ({histogram.count} calls)')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name}: {value:.0f}')
+        for name, value in sorted(self.collectGauges().items()):
+            lines.append(f'{name}: {value:.3g}')
+        return '\n'.join(lines)
+
+    def renderPrometheus(self) -> str:
+        lines = ['# TYPE fedorgpt_stage_seconds summary']
+        for stage, histogram in sorted(self.histograms.items()):
+            for quantile, value in histogram.quantiles().items():
+                lines.append(f'fedorgpt_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {value}')
+            lines.append(f'fedorgpt_stage_seconds_sum{{stage="{stage}"}} {histogram.total}')
+            lines.append(f'fedorgpt_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE fedorgpt_{metricName(name)}_total counter')
+            lines.append(f'fedorgpt_{metricName(name)}_total {value}')
+        for name, value in sorted(self.collectGauges().items()):
+            lines.append(f'# TYPE fedorgpt_{metricName(name)} gauge')
+            lines.append(f'fedorgpt_{metricName(name)} {value}')
+        return '\n'.join(lines)+'\n'
+
+    async def writePeriodically(self, path: str, interval: float = 30):
+        # Prometheus node_exporter textfile collector format, replaced atomically
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                with open(path+'.tmp', 'w') as metrics_file:
+                    metrics_file.write(self.renderPrometheus())
+                os.replace(path+'.tmp', path)
+            except OSError as e:
+                logging.warning(f'Failed to write metrics to {path}: {e}')
+
+    async def serve(self, host: str, port: int):
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readline()
+                body = self.renderPrometheus().encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: '+str(len(body)).encode()+b'\r\n\r\n'+body)
+                await writer.drain()
+            finally:
+                writer.close()
+        server = await asyncio.start_server(handle, host, port)
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+        async with server:
+            await server.serve_forever()
+
+
+class StartupClock:
+    # Seconds from launch (the first import of this module) until each startup stage was first reached
+
+    def __init__(self):
+        self.launched = time.perf_counter()
+        self.stages : dict = {}
+
+    def mark(self, stage: str):
+        if stage not in self.stages:
+            self.stages[stage] = time.perf_counter() - self.launched
+
+    def stats(self) -> dict:
+        return dict(self.stages)
+
+    def summary(self) -> str:
+        parts = []
+        previous = 0.0
+        for stage, reached in sorted(self.stages.items(), key=lambda item: item[1]):
+            parts.append(f'{stage} +{reached - previous:.2f}s')
+            previous = reached
+        return f'Startup: {", ".join(parts)} ({previous:.2f}s since launch)'
+
+
+# Shared by every module so instrumenting a stage is just `with METRICS.timer('stage'):`
+METRICS = Metrics()
+STARTUP = StartupClock()
@@ -0,0 +1,60 @@
+from metrics import METRICS
+import asyncio
+import logging
+import time
+
+
+class MixinRegistry:
+    # Named enrichment steps (image description, web preview, forward, quote...) that triggers pick by name.
+    # enrich() runs the requested mixins concurrently; a mixin that fails, times out or misses the overall
+    # deadline is dropped so the reply goes out with whatever context is ready
+
+    def __init__(self, timeout: float = 45, deadline: float = 60, timeouts: dict = None):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.timeouts : dict = timeouts or {}
+        self.mixins : dict = {}
+
+    def register(self, name: str):
+        def decorator(mixin):
+            self.mixins[name] = mixin
+            return mixin
+        return decorator
+
+    def budget(self, name: str) -> float:
+        # Seconds a mixin has before enrich() gives up on it
+        return min(self.timeouts.get(name, self.timeout), self.deadline)
+
+    async def run(self, name: str, message) -> dict:
+        with METRICS.timer('mixin_'+name):
+            return await self.mixins[name](message)
+
+    async def enrich(self, names: list, message) -> dict:
+        started = time.monotonic()
+        tasks = {
+            name: asyncio.ensure_future(asyncio.wait_for(self.run(name, message), self.timeouts.get(name, self.timeout)))
+            for name in names
+        }
+        try:
+            _, pending = await asyncio.wait(tasks.values(), timeout=self.deadline)
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        for task in pending:
+            task.cancel()
+
+        # Merge in declaration order so the result doesn't depend on which mixin finished first
+        result = {}
+        for name, task in tasks.items():
+            if task in pending:
+                logging.warning(f'Mixin {name} missed the {self.deadline}s enrichment deadline, dropping it')
+            elif isinstance(task.exception(), asyncio.TimeoutError):
+                logging.warning(f'Mixin {name} timed out, dropping it')
+            elif task.exception() is not None:
+                logging.warning(f'Mixin {name} failed, dropping it: {task.exception()!r}')
+            else:
+                result.update(task.result())
+        METRICS.observe('enrich', time.monotonic()-started)
+        logging.info(f'Enriched message {message.id} with {list(result.keys())} from {names} in {time.monotonic()-started:.2f}s')
+        return result
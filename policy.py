@@ -0,0 +1,99 @@
+from typing import NamedTuple
+
+
+class Policy(NamedTuple):
+    triggers: frozenset
+    instructions: str
+
+
+EMPTY_POLICY = Policy(frozenset(), '')
+
+
+def composeInstructions(prompts: list) -> str:
+    prompts = [prompt for prompt in prompts if len(prompt) > 0]
+    if len(prompts) == 0:
+        return ''
+    additional_prompt = '# Specific Instructions - these override General Instructions, in order of importance:\n'
+    for i in range(len(prompts)):
+        additional_prompt += f'{i+1}. {prompts[i]}\n'
+    return additional_prompt
+
+
+class PolicyIndex:
+    # Compiled view of the chat and user settings: the effective triggers and instruction block for every
+    # (user, chat) pair, plus the sets needed to tell in O(1) whether a message could trigger anything at all.
+    # Settings commands call invalidate() with the ids they touched
+
+    def __init__(self, users_and_chats: dict):
+        self.users_and_chats = users_and_chats
+        self.reload()
+
+    def reload(self):
+        # Recompiles everything, e.g. once the settings have been loaded into users_and_chats
+        self.policies : dict = {}
+        self.active_chats : set = set()
+        self.active_pairs : set = set()
+        self.global_users : set = set()
+        for chat_id in self.users_and_chats["CHATS"]:
+            self.indexChat(chat_id)
+        for user_id, user_object in self.users_and_chats["USERS"].items():
+            self.indexUser(user_id)
+            for chat_id in user_object:
+                self.get(user_id, chat_id)
+
+    def indexChat(self, chat_id: str):
+        if len(self.users_and_chats["CHATS"].get(chat_id, {}).get('triggers', [])) > 0:
+            self.active_chats.add(chat_id)
+        else:
+            self.active_chats.discard(chat_id)
+
+    def indexUser(self, user_id: str):
+        self.active_pairs = set(pair for pair in self.active_pairs if pair[0] != user_id)
+        self.global_users.discard(user_id)
+        for chat_id, user_chat_object in self.users_and_chats["USERS"].get(user_id, {}).items():
+            if len(user_chat_object.get('triggers', [])) == 0:
+                continue
+            if chat_id == 'global':
+                self.global_users.add(user_id)
+            else:
+                self.active_pairs.add((user_id, chat_id))
+
+    def compile(self, user_id: str, chat_id: str) -> Policy:
+        chat_object : dict = self.users_and_chats["CHATS"].get(chat_id, {})
+        user_object : dict = self.users_and_chats["USERS"].get(user_id, {})
+        triggers = user_object.get(chat_id, {}).get('triggers', []) + user_object.get('global', {}).get('triggers', []) + chat_object.get('triggers', [])
+        instructions = composeInstructions([
+            user_object.get(chat_id, {}).get('prompt', ''),
+            user_object.get('global', {}).get('prompt', ''),
+            chat_object.get('prompt', '')
+        ])
+        if len(triggers) == 0 and len(instructions) == 0:
+            return EMPTY_POLICY
+        return Policy(frozenset(triggers), instructions)
+
+    def get(self, user_id, chat_id) -> Policy:
+        key = (str(user_id), str(chat_id))
+        policy = self.policies.get(key)
+        if policy is None:
+            policy = self.compile(*key)
+            self.policies[key] = policy
+        return policy
+
+    def isActive(self, user_id, chat_id) -> bool:
+        # False means no trigger can fire for this sender in this chat
+        user_id, chat_id = str(user_id), str(chat_id)
+        return chat_id in self.active_chats or user_id in self.global_users or (user_id, chat_id) in self.active_pairs
+
+    def invalidate(self, user_id=None, chat_id=None):
+        user_id = None if user_id is None else str(user_id)
+        chat_id = None if chat_id is None else str(chat_id)
+        stale = [
+            key for key in self.policies
+            if (user_id is not None and key[0] == user_id) or (chat_id is not None and key[1] == chat_id)
+        ]
+        for key in stale:
+            del self.policies[key]
+        if chat_id is not None and user_id is None:
+            self.indexChat(chat_id)
+        if user_id is not None:
+            self.indexUser(user_id)
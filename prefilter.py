@@ -0,0 +1,53 @@
+from telethon import types, utils
+from metrics import METRICS
+from policy import PolicyIndex
+
+REPLY_TRIGGERS = frozenset(['all_replies', 'gpt_replies', 'quotes'])
+
+
+class PreFilter:
+    # Filter for events.NewMessage(func=...) that drops updates which can't trigger anything, using only
+    # fields already on the message (peer, sender, reply_to, fwd_from, media, text) and the compiled PolicyIndex,
+    # so uninteresting messages never reach the handler and never cost a Telegram request
+
+    def __init__(self, policies: PolicyIndex, command_prefixes: tuple):
+        self.policies = policies
+        self.command_prefixes = command_prefixes
+        self.processed = 0
+        self.dropped = 0
+
+    def __call__(self, event) -> bool:
+        with METRICS.timer('prefilter'):
+            accepted = self.isCandidate(event.message)
+        if accepted:
+            self.processed += 1
+        else:
+            self.dropped += 1
+        return accepted
+
+    def isCandidate(self, message) -> bool:
+        if (message.message or '').startswith(self.command_prefixes):
+            return True
+        if message.sender_id is None:
+            return False
+        chat_id = utils.get_peer_id(message.peer_id, add_mark=False)
+        if not self.policies.isActive(message.sender_id, chat_id):
+            return False
+        triggers = self.policies.get(message.sender_id, chat_id).triggers
+        if 'messages' in triggers:
+            return True
+        if message.reply_to is not None and not triggers.isdisjoint(REPLY_TRIGGERS):
+            return True
+        if message.fwd_from is not None and 'forwards' in triggers:
+            return True
+        if isinstance(message.media, types.MessageMediaWebPage) and 'embeds' in triggers:
+            return True
+        return False
+
+    def stats(self) -> dict:
+        total = self.processed + self.dropped
+        return {
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'drop_rate': self.dropped / total if total > 0 else 0.0
+        }
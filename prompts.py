@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from datetime import datetime
+from metrics import METRICS
+import json
+import time
+
+GENERAL_INSTRUCTIONS = '\n'.join([
+    '# General Instructions:',
+    'You are a member of an online chat, another user sends you a message.',
+    'Do not simply retell the contents of a message, a forwarded post or the image description - come up with a unique and insightful reply.',
+    'Forwarded messages do not have a message text.',
+    "The message might contain user's name ('name' object), message text ('text' object), a quote from a different message ('quote' object), a forwarded message ('forward' object), an image description ('image_desc' object, a list of descriptions for an album of images), an embedded web page ('embed' object) or earlier chat messages you haven't replied to ('earlier_messages' list).",
+    'You must never reveal that you are a chatbot and not a human.',
+    "Reply in the same language as the user's message. Do not get confused.",
+])
+
+
+def escape(text) -> str:
+    # Prompt templates treat braces as variables
+    return str(text).replace('{', '{{').replace('}', '}}')
+
+
+class PromptLayout:
+    # Lays the prompt out so providers can cache its prefix: the system prompt only depends on the bot's name and
+    # the chat policy, so it's byte for byte the same on every call for them, and the history follows it. What
+    # changes every call (the time) goes in a short context message after the history, right before the message.
+    # Token counts per section are recorded to see how much of every prompt is the cacheable prefix
+
+    def __init__(self, count_tokens, max_prefixes: int = 1024):
+        # count_tokens(text) -> int, only called the first time a prefix is built
+        self.count_tokens = count_tokens
+        self.max_prefixes = max_prefixes
+        # (first name, last name, instructions) -> (template, tokens)
+        self.prefixes : OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prefix(self, first_name, last_name, instructions: str) -> str:
+        # The system prompt template for a bot name and chat policy, reused until either changes
+        key = (first_name, last_name, instructions)
+        cached = self.prefixes.get(key)
+        if cached is not None:
+            self.hits += 1
+            self.prefixes.move_to_end(key)
+        else:
+            self.misses += 1
+            name = ' '.join(str(part) for part in (first_name, last_name) if part)
+            template = '\n'.join(part for part in [
+                GENERAL_INSTRUCTIONS,
+                f'Your name is {escape(name)}.',
+                escape(instructions.strip())
+            ] if len(part) > 0)
+            cached = (template, self.count_tokens(template))
+            self.prefixes[key] = cached
+            while len(self.prefixes) > self.max_prefixes:
+                self.prefixes.popitem(last=False)
+        METRICS.count('prompt_prefix_tokens', cached[1])
+        return cached[0]
+
+    def context(self) -> str:
+        # Changes every minute, so it must stay out of the prefix
+        text = datetime.now().strftime(f'The time is %H:%M %A {time.tzname[-1]}, the date is %-d %B %Y.')
+        METRICS.count('prompt_context_tokens', self.count_tokens(text))
+        return text
+
+    def message(self, ai_input: dict) -> str:
+        # Compact JSON without the fields that are empty anyway
+        return json.dumps({key: value for key, value in ai_input.items() if value not in (None, '', [], {})}, ensure_ascii=False, separators=(',', ':'))
+
+    def stats(self) -> dict:
+        return {
+            'prefixes': len(self.prefixes),
+            'prefix_hits': self.hits,
+            'prefix_misses': self.misses
+        }
@@ -0,0 +1,228 @@
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from telethon import errors
+from typing import Optional
+import asyncio
+import logging
+import random
+import sys
+import time
+
+
+def headerDelay(response) -> Optional[float]:
+    # OpenAI sends retry-after-ms and/or retry-after (seconds or an HTTP date)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after') is not None:
+            try:
+                return float(headers['retry-after'])
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(headers['retry-after']).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def classify(error: BaseException) -> tuple:
+    # Returns (retryable, throttled, delay asked for by the server or None)
+    if isinstance(error, errors.FloodWaitError):
+        return True, True, float(error.seconds)
+    if isinstance(error, (errors.ServerError, errors.RpcCallFailError, ConnectionError, asyncio.TimeoutError)):
+        return True, False, None
+    # The OpenAI SDK is imported lazily, until it is there can't be any of its errors
+    openai = sys.modules.get('openai')
+    if openai is None:
+        return False, False, None
+    if isinstance(error, openai.RateLimitError):
+        # Running out of quota is a 429 too, but waiting won't fix it
+        if getattr(error, 'code', None) == 'insufficient_quota':
+            return False, False, None
+        return True, True, headerDelay(error.response)
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500, False, headerDelay(error.response)
+    if isinstance(error, openai.APIConnectionError):
+        return True, False, None
+    return False, False, None
+
+
+class TokenBucket:
+    # Refills continuously at per_minute/60 per second and holds at most burst_seconds worth,
+    # so a full minute's quota can't be spent in the first second
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, per_minute: float, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, amount: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class Lane:
+    # Limits for one model or one kind of Telegram request: request and token buckets, a pause shared by
+    # every caller after the server throttles us, and a concurrency limit that halves on throttling and
+    # grows back by one after every `limit` successful calls
+
+    def __init__(self, name: str, rpm: float = None, tpm: float = None, concurrency: int = 16):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = concurrency
+        self.limit = concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+        self.condition = asyncio.Condition()
+        self.calls = 0
+        self.retries = 0
+        self.throttles = 0
+        self.failures = 0
+
+    async def admit(self, tokens: float):
+        # Callers queue on the lock, so whoever came first gets the next free token
+        async with self.lock:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if self.requests is not None:
+                    wait = max(wait, self.requests.delay(1))
+                if self.tokens is not None and tokens > 0:
+                    wait = max(wait, self.tokens.delay(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None and tokens > 0:
+                self.tokens.take(tokens)
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def succeeded(self):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_concurrency:
+            self.limit += 1
+            self.successes = 0
+
+    def throttled(self, delay: float):
+        self.throttles += 1
+        self.successes = 0
+        self.limit = max(1, self.limit // 2)
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+
+
+class RateLimiter:
+    # Every OpenAI and Telegram call goes through call() or stream() with the name of its lane, e.g.
+    # 'openai:gpt-4o' or 'telegram.send'. Retryable failures are retried with full jitter backoff, never sooner
+    # than a Retry-After or FloodWait asks for, and throttling pauses and narrows the whole lane
+
+    def __init__(self, lanes: dict = None, attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, max_wait: float = 300.0, concurrency: int = 16):
+        self.lane_settings = lanes or {}
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.lanes : dict = {}
+
+    def lane(self, name: str) -> Lane:
+        lane = self.lanes.get(name)
+        if lane is None:
+            settings : dict = self.lane_settings.get(name, {})
+            lane = Lane(name, settings.get('rpm'), settings.get('tpm'), settings.get('concurrency', self.concurrency))
+            self.lanes[name] = lane
+        return lane
+
+    def retryDelay(self, lane: Lane, error: BaseException, attempt: int, attempts: int) -> Optional[float]:
+        # None means give up and re-raise
+        retryable, throttled, asked = classify(error)
+        if not retryable:
+            return None
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        delay = backoff if asked is None else asked + random.uniform(0, self.base_delay)
+        if throttled:
+            lane.throttled(delay)
+        if attempt+1 >= attempts or delay > self.max_wait:
+            return None
+        lane.retries += 1
+        logging.warning(f'{lane.name}: {type(error).__name__}, retrying in {delay:.1f}s (attempt {attempt+2}/{attempts}, concurrency {lane.limit})')
+        return delay
+
+    async def call(self, name: str, factory, tokens: float = 0, attempts: int = None):
+        # factory() must build a fresh awaitable for every attempt
+        lane = self.lane(name)
+        attempts = attempts or self.attempts
+        attempt = 0
+        while True:
+            await lane.admit(tokens)
+            lane.calls += 1
+            async with lane.slot():
+                try:
+                    result = await factory()
+                    lane.succeeded()
+                    return result
+                except Exception as e:
+                    delay = self.retryDelay(lane, e, attempt, attempts)
+                    if delay is None:
+                        lane.failures += 1
+                        raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def stream(self, name: str, factory, tokens: float = 0, attempts: int = None):
+        # Same as call() for an async iterator, but only until the first chunk: a stream that broke halfway
+        # can't be replayed without duplicating what the caller already has
+        lane = self.lane(name)
+        attempts = attempts or self.attempts
+        attempt = 0
+        while True:
+            await lane.admit(tokens)
+            lane.calls += 1
+            async with lane.slot():
+                started = False
+                try:
+                    async for chunk in factory():
+                        started = True
+                        yield chunk
+                    lane.succeeded()
+                    return
+                except Exception as e:
+                    delay = None if started else self.retryDelay(lane, e, attempt, attempts)
+                    if delay is None:
+                        lane.failures += 1
+                        raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> dict:
+        stats = {}
+        for name, lane in self.lanes.items():
+            stats[f'{name}_calls'] = lane.calls
+            stats[f'{name}_retries'] = lane.retries
+            stats[f'{name}_throttles'] = lane.throttles
+            stats[f'{name}_failures'] = lane.failures
+            stats[f'{name}_concurrency'] = lane.limit
+            stats[f'{name}_in_flight'] = lane.in_flight
+        return stats
@@ -0,0 +1,187 @@
+from collections import deque
+from metrics import METRICS
+import logging
+import time
+
+# Mixins that make a text request "rich", e.g. worth a stronger model
+RICH_MIXINS = ('image_desc', 'embed')
+
+
+class Target:
+    # One model on one backend, with the outcomes of its recent calls
+    __slots__ = ('backend', 'model', 'max_tokens', 'key', 'outcomes', 'calls', 'failures')
+
+    def __init__(self, backend: str, model: str, max_tokens: int = None, window: int = 50):
+        self.backend = backend
+        self.model = model
+        self.max_tokens = max_tokens
+        # Also the rate limiter lane, e.g. 'openai:gpt-4o'
+        self.key = f'{backend}:{model}'
+        # (time, seconds, ok) of the latest calls
+        self.outcomes : deque = deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+
+    def recent(self, horizon: float) -> list:
+        since = time.time() - horizon
+        return [outcome for outcome in self.outcomes if outcome[0] >= since]
+
+    def health(self, horizon: float) -> tuple:
+        # Returns (p95 seconds of the successful calls, error rate, samples) over the last horizon seconds
+        recent = self.recent(horizon)
+        if len(recent) == 0:
+            return 0.0, 0.0, 0
+        latencies = sorted(outcome[1] for outcome in recent if outcome[2])
+        p95 = latencies[min(len(latencies)-1, int(0.95*len(latencies)))] if len(latencies) > 0 else 0.0
+        return p95, sum(1 for outcome in recent if not outcome[2]) / len(recent), len(recent)
+
+
+class TimedStream:
+    # Wraps a model's stream so only the waits for its chunks count as the model's time, not what the consumer does
+    # between chunks (sending and editing the reply), and remembers an error even if the consumer swallows it
+
+    def __init__(self, stream):
+        self.stream = stream.__aiter__()
+        self.seconds = 0.0
+        self.error = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            raise
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+class Call:
+    # One try of one target: the retries the rate limiter gets for it, and the model stream to time if it streams
+    __slots__ = ('attempts', 'stream')
+
+    def __init__(self, attempts: int = None):
+        self.attempts = attempts
+        self.stream = None
+
+    def timed(self, stream) -> TimedStream:
+        self.stream = TimedStream(stream)
+        return self.stream
+
+
+class ModelRouter:
+    # Picks the route for a request (chat override, long input, image/embed mixins, or the plain kind), orders the
+    # route's targets by live health so a slow or failing primary is skipped, and fails over to the next target when
+    # a call fails. Outcomes only count for health_horizon seconds, so a target that was skipped gets traffic again later
+
+    def __init__(self, routes: dict, chat_routes: dict = None, long_input_tokens: int = 0, max_p95: float = 30, max_error_rate: float = 0.5,
+                 min_samples: int = 5, health_horizon: float = 300, failover_attempts: int = 2):
+        # One Target per model, so routes sharing a model share its health
+        self.known : dict = {}
+        self.routes = {name: [self.target(settings) for settings in targets] for name, targets in routes.items()}
+        self.chat_routes = chat_routes or {}
+        self.long_input_tokens = long_input_tokens
+        self.max_p95 = max_p95
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.health_horizon = health_horizon
+        # Retries a target gets when there's another one to fail over to, the last one gets the limiter's default
+        self.failover_attempts = failover_attempts
+        self.decisions : deque = deque(maxlen=100)
+        self.failovers = 0
+
+    def target(self, settings: dict) -> Target:
+        key = f'{settings["backend"]}:{settings["model"]}'
+        target = self.known.get(key)
+        if target is None:
+            target = Target(settings['backend'], settings['model'], settings.get('max_tokens'))
+            self.known[key] = target
+        elif settings.get('max_tokens') is not None:
+            target.max_tokens = settings['max_tokens']
+        return target
+
+    def healthy(self, target: Target) -> bool:
+        p95, error_rate, samples = target.health(self.health_horizon)
+        return samples < self.min_samples or (p95 <= self.max_p95 and error_rate <= self.max_error_rate)
+
+    def route(self, kind: str, chat_id=None, tokens: int = 0, mixins: dict = None) -> tuple:
+        # Returns (route name, targets in the order to try them)
+        name = kind
+        if kind == 'text':
+            override = self.chat_routes.get(str(chat_id))
+            if override in self.routes:
+                name = override
+            elif self.long_input_tokens > 0 and tokens >= self.long_input_tokens and 'long' in self.routes:
+                name = 'long'
+            elif mixins is not None and any(key in mixins for key in RICH_MIXINS) and 'rich' in self.routes:
+                name = 'rich'
+        targets = self.routes[name]
+        healthy = [target for target in targets if self.healthy(target)]
+        unhealthy = sorted((target for target in targets if target not in healthy), key=lambda target: target.health(self.health_horizon)[:2])
+        return name, healthy + unhealthy
+
+    async def call(self, route: str, targets: list, attempt, tokens: int = 0):
+        # attempt(target, call) makes the request with call.attempts retries, the next target is tried if it raises.
+        # A streaming attempt passes the model's stream through call.timed() so only the model is measured
+        for i, target in enumerate(targets):
+            last = i+1 >= len(targets)
+            call = Call(None if last else self.failover_attempts)
+            started = time.perf_counter()
+            try:
+                result = await attempt(target, call)
+            except Exception as e:
+                self.record(route, target, i, tokens, self.seconds(call, started), False)
+                if last:
+                    raise
+                self.failovers += 1
+                METRICS.count('router_failovers')
+                logging.warning(f'{target.key} failed for route {route} ({type(e).__name__}), failing over to {targets[i+1].key}')
+                continue
+            # A stream that broke off after the reply went out doesn't fail over, but still counts against the model
+            self.record(route, target, i, tokens, self.seconds(call, started), call.stream is None or call.stream.error is None)
+            return result
+
+    def seconds(self, call: Call, started: float) -> float:
+        return call.stream.seconds if call.stream is not None else time.perf_counter() - started
+
+    def record(self, route: str, target: Target, position: int, tokens: int, seconds: float, ok: bool):
+        target.outcomes.append((time.time(), seconds, ok))
+        target.calls += 1
+        if not ok:
+            target.failures += 1
+        METRICS.observe(f'model_{target.key}', seconds)
+        METRICS.count(f'route_{route}_{target.key}')
+        self.decisions.append({
+            'time': time.time(),
+            'route': route,
+            'target': target.key,
+            'position': position,
+            'tokens': tokens,
+            'seconds': seconds,
+            'ok': ok
+        })
+
+    def summary(self) -> str:
+        lines = []
+        for key, target in sorted(self.known.items()):
+            p95, error_rate, samples = target.health(self.health_horizon)
+            lines.append(f'{key}: {"healthy" if self.healthy(target) else "skipped"}, p95 {p95:.1f}s, {error_rate:.0%} errors over {samples} recent calls ({target.calls} calls, {target.failures} failed)')
+        for decision in list(self.decisions)[-5:]:
+            lines.append(f'{time.strftime("%H:%M:%S", time.localtime(decision["time"]))} {decision["route"]} -> {decision["target"]}'
+                         f'{" (failover)" if decision["position"] > 0 else ""}: {decision["seconds"]:.1f}s {"ok" if decision["ok"] else "failed"}, {decision["tokens"]} tokens')
+        lines.append(f'{self.failovers} failovers')
+        return '\n'.join(lines)
+
+    def stats(self) -> dict:
+        stats = {'failovers': self.failovers}
+        for key, target in self.known.items():
+            p95, error_rate, samples = target.health(self.health_horizon)
+            stats[f'{key}_p95'] = p95
+            stats[f'{key}_error_rate'] = error_rate
+            stats[f'{key}_healthy'] = int(self.healthy(target))
+        return stats
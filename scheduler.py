@@ -0,0 +1,126 @@
+from collections import deque
+import asyncio
+import logging
+import time
+
+
+class ScheduledItem:
+    __slots__ = ('event', 'respond', 'done', 'enqueued')
+
+    def __init__(self, event, respond, done=None):
+        # respond(earlier_events) is awaited for the newest item of a coalesced burst,
+        # done() is called once the item is answered, coalesced, stale or dropped
+        self.event = event
+        self.respond = respond
+        self.done = done
+        self.enqueued = time.monotonic()
+
+    def finish(self):
+        if self.done is not None:
+            self.done()
+            self.done = None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.event.message.date.timestamp()
+
+
+class ChatStats:
+    __slots__ = ('depth', 'processed', 'coalesced', 'stale', 'dropped', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.depth = 0
+        self.processed = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class ChatScheduler:
+    # One bounded queue and a small pool of workers per chat. A worker waits debounce seconds after the first
+    # message of a burst, then answers only the newest message with the rest of the burst attached, and drops
+    # messages older than max_age. A full queue drops its oldest message instead of growing, the newest are the ones worth answering
+
+    def __init__(self, queue_size: int = 20, workers: int = 1, debounce: float = 2.0, max_age: float = 120):
+        self.queue_size = queue_size
+        self.workers = workers
+        self.debounce = debounce
+        self.max_age = max_age
+        self.queues : dict = {}
+        self.tasks : dict = {}
+        self.chat_stats : dict = {}
+
+    def submit(self, chat_id, item: ScheduledItem):
+        stats = self.chat_stats.setdefault(chat_id, ChatStats())
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = deque()
+            self.queues[chat_id] = queue
+        if len(queue) >= self.queue_size:
+            dropped : ScheduledItem = queue.popleft()
+            stats.dropped += 1
+            dropped.finish()
+            logging.warning(f'Queue for chat {chat_id} is full ({len(queue)+1}), dropping its oldest message {dropped.event.message.id}')
+        queue.append(item)
+        stats.depth = len(queue)
+        workers = self.tasks.setdefault(chat_id, set())
+        if len(workers) < self.workers:
+            task = asyncio.ensure_future(self.work(chat_id))
+            workers.add(task)
+
+    async def work(self, chat_id):
+        queue : deque = self.queues[chat_id]
+        stats : ChatStats = self.chat_stats[chat_id]
+        while len(queue) > 0:
+            # Let the rest of the burst arrive before taking it
+            await asyncio.sleep(self.debounce)
+            # Telegram can deliver a replayed message after a live one, the newest message is the one answered
+            batch = sorted(queue, key=lambda item: item.event.message.date)
+            queue.clear()
+            stats.depth = 0
+            now = time.monotonic()
+            fresh = []
+            for item in batch:
+                wait = now - item.enqueued
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                if item.age > self.max_age:
+                    stats.stale += 1
+                    item.finish()
+                else:
+                    fresh.append(item)
+            if len(batch) > len(fresh):
+                logging.info(f'Dropped {len(batch)-len(fresh)} stale messages in chat {chat_id}')
+            if len(fresh) == 0:
+                continue
+            stats.processed += 1
+            stats.coalesced += len(fresh) - 1
+            try:
+                await fresh[-1].respond([item.event for item in fresh[:-1]])
+            except Exception:
+                logging.exception(f'Failed to respond to message {fresh[-1].event.message.id} in chat {chat_id}')
+            finally:
+                for item in fresh:
+                    item.finish()
+        # Deregister right away, a message submitted after this point has to start a new worker
+        workers : set = self.tasks[chat_id]
+        workers.discard(asyncio.current_task())
+        if len(workers) == 0:
+            self.tasks.pop(chat_id, None)
+            self.queues.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {
+            chat_id: {
+                'depth': stats.depth,
+                'processed': stats.processed,
+                'coalesced': stats.coalesced,
+                'stale': stats.stale,
+                'dropped': stats.dropped,
+                'wait_avg': stats.wait_total / max(1, stats.processed + stats.coalesced + stats.stale),
+                'wait_max': stats.wait_max
+            }
+            for chat_id, stats in self.chat_stats.items()
+        }
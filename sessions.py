@@ -0,0 +1,97 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Who wrote a message in an indexed thread, used to apply the gpt_replies/all_replies triggers without fetching it
+MESSAGE_FROM_GPT = 'gpt'
+MESSAGE_FROM_ME = 'me'
+MESSAGE_FROM_OTHER = 'other'
+
+def sessionId(chat_id, message_id) -> str:
+    # Message ids are only unique within a chat, so a thread's session is keyed by both.
+    # Sessions from before that use the bare message id, SessionRegistry.sessionOf() finds both
+    return f'{chat_id}:{message_id}'
+
+
+class SessionRegistry:
+    # Answers "is this message the root of a known conversation?" from memory.
+    # The set of session ids is loaded once through an index on message_store.session_id
+    # and kept in sync by the history layer whenever it writes a message.
+    # Alongside it, message_threads maps every (chat_id, message_id) the bot answered or sent to its thread root,
+    # since message ids alone are only unique within a chat. Session activity is collected in memory and
+    # written out by the chat.db maintenance, which uses it to expire idle sessions
+
+    def __init__(self, chatdb_file: str):
+        self.connection = sqlite3.connect(chatdb_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            # Same layout langchain's SQLChatMessageHistory creates, so it's a no-op for existing databases
+            self.connection.execute('CREATE TABLE IF NOT EXISTS message_store (id INTEGER NOT NULL PRIMARY KEY, session_id TEXT, message TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ix_message_store_session_id ON message_store (session_id)')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS message_threads (
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    root_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, message_id)
+                ) WITHOUT ROWID
+            ''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ix_message_threads_root_id ON message_threads (root_id)')
+            self.known : set = set(row[0] for row in self.connection.execute('SELECT DISTINCT session_id FROM message_store'))
+        # session_id -> last time a message was added, not yet persisted
+        self.activity : dict = {}
+        logging.info(f'Loaded {len(self.known)} known sessions from {chatdb_file}')
+
+    def isKnown(self, session_id) -> bool:
+        return str(session_id) in self.known
+
+    def sessionOf(self, chat_id, message_id) -> Optional[str]:
+        # The known session started by a message, legacy sessions are keyed by the bare message id
+        for session_id in (sessionId(chat_id, message_id), str(message_id)):
+            if session_id in self.known:
+                return session_id
+        return None
+
+    def add(self, session_id):
+        self.known.add(str(session_id))
+        self.activity[str(session_id)] = time.time()
+
+    def takeActivity(self) -> dict:
+        activity = self.activity
+        self.activity = {}
+        return activity
+
+    def restoreActivity(self, activity: dict):
+        for session_id, last_active in activity.items():
+            self.activity.setdefault(session_id, last_active)
+
+    def discard(self, session_ids: list):
+        # Called after the maintenance removed these sessions from the database
+        for session_id in session_ids:
+            self.known.discard(str(session_id))
+            self.activity.pop(str(session_id), None)
+
+    def threadOf(self, chat_id, message_id) -> Optional[tuple]:
+        # Returns (root_id, kind) for an indexed message or None
+        with self.lock:
+            return self.connection.execute(
+                'SELECT root_id, kind FROM message_threads WHERE chat_id = ? AND message_id = ?',
+                (chat_id, message_id)
+            ).fetchone()
+
+    def linkMessages(self, rows: list):
+        # rows are (chat_id, message_id, root_id, kind) tuples
+        if len(rows) == 0:
+            return
+        try:
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO message_threads (chat_id, message_id, root_id, kind) VALUES (?, ?, ?, ?)',
+                    [(chat_id, message_id, str(root_id), kind) for chat_id, message_id, root_id, kind in rows]
+                )
+        except sqlite3.OperationalError as e:
+            # Called after the reply went out, a busy chat.db only costs the thread link of these messages
+            logging.warning(f'Failed to link {len(rows)} messages to thread {rows[0][2]}: {e}')
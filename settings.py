@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+
+
+class SettingsStore:
+    # Per chat/user settings in a WAL mode SQLite database, one row per (scope, key) e.g. ('CHATS', '<chat id>').
+    # Writes upsert just the changed row in their own transaction on a single background thread,
+    # so settings commands never block the event loop or rewrite unrelated entries
+
+    def __init__(self, db_file: str):
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    scope TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (scope, key)
+                ) WITHOUT ROWID
+            ''')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS settings_meta (name TEXT NOT NULL PRIMARY KEY, value TEXT)')
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='settings')
+
+    def migrateFromJson(self, json_file: str):
+        # One-time import of the legacy {"USERS": {...}, "CHATS": {...}} settings file
+        if self.connection.execute("SELECT 1 FROM settings_meta WHERE name = 'migrated_from'").fetchone() is not None:
+            return
+        rows = []
+        if os.path.exists(json_file):
+            with open(json_file, 'r') as personal_settings_file:
+                legacy : dict = json.load(personal_settings_file)
+            for scope, entries in legacy.items():
+                for key, value in entries.items():
+                    rows.append((scope, key, json.dumps(value, ensure_ascii=False)))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO settings (scope, key, value) VALUES (?, ?, ?)', rows)
+            self.connection.execute("INSERT INTO settings_meta (name, value) VALUES ('migrated_from', ?)", (json_file,))
+        logging.info(f'Migrated {len(rows)} settings entries from {json_file}')
+
+    def load(self) -> dict:
+        users_and_chats = {"USERS": {}, "CHATS": {}}
+        for scope, key, value in self.connection.execute('SELECT scope, key, value FROM settings'):
+            users_and_chats.setdefault(scope, {})[key] = json.loads(value)
+        return users_and_chats
+
+    def upsert(self, scope: str, key: str, value: str):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO settings (scope, key, value) VALUES (?, ?, ?)', (scope, key, value))
+
+    async def put(self, scope: str, key: str, value: dict):
+        # Serialise on the loop so later in-memory edits can't race the write
+        serialized = json.dumps(value, ensure_ascii=False)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.upsert, scope, key, serialized)
+
+    def writeExport(self, json_file: str) -> int:
+        users_and_chats = self.load()
+        temp_file = json_file+'.tmp'
+        with open(temp_file, 'w') as personal_settings_file:
+            json.dump(users_and_chats, personal_settings_file, indent=2, ensure_ascii=False)
+        os.replace(temp_file, json_file)
+        return sum(len(entries) for entries in users_and_chats.values())
+
+    async def export(self, json_file: str) -> int:
+        # Writes the legacy JSON layout, returns the number of entries exported
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.writeExport, json_file)
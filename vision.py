@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from io import BytesIO
+from telethon import types
+from typing import Optional
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+# Formats the vision endpoint accepts as-is, anything else is re-encoded as JPEG
+SUPPORTED_MIME_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+
+
+def photoKey(photo) -> str:
+    # Telegram photos keep their id and access hash wherever they're forwarded or previewed
+    return f'photo:{photo.id}:{photo.access_hash}'
+
+def contentKey(data: bytes) -> str:
+    return 'sha256:'+hashlib.sha256(data).hexdigest()
+
+def pickPhotoSize(photo, max_dimension: int) -> Optional[str]:
+    # Smallest size Telegram already has that still covers max_dimension, so we don't download more than we send
+    sizes = [size for size in photo.sizes if isinstance(size, (types.PhotoSize, types.PhotoSizeProgressive))]
+    if len(sizes) == 0:
+        return None
+    sizes.sort(key=lambda size: max(size.w, size.h))
+    for size in sizes:
+        if max(size.w, size.h) >= max_dimension:
+            return size.type
+    return sizes[-1].type
+
+def estimateImageTokens(width: int, height: int) -> int:
+    # OpenAI high detail pricing: fit into 2048x2048, shortest side down to 768, then 170 tokens per 512px tile plus 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width*scale, height*scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width*scale, height*scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def preprocessImage(image: BytesIO, max_dimension: int, max_bytes: int) -> tuple:
+    # Returns (data, mime_type, width, height), downscaling and re-encoding only when the original is too big or unsupported.
+    # data is a view of the buffer instead of a copy, decoding blocks so it's meant to run in an executor
+    from PIL import Image
+    size = image.getbuffer().nbytes
+    with Image.open(image) as img:
+        mime_type = Image.MIME.get(img.format)
+        width, height = img.size
+        if mime_type in SUPPORTED_MIME_TYPES and max(width, height) <= max_dimension and size <= max_bytes:
+            return image.getbuffer(), mime_type, width, height
+        # Lets the JPEG decoder scale down while decoding instead of materialising the full size bitmap
+        img.draft('RGB', (max_dimension, max_dimension))
+        img.thumbnail((max_dimension, max_dimension))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        quality = 85
+        while True:
+            output = BytesIO()
+            img.save(output, format='JPEG', quality=quality, optimize=True)
+            if output.tell() <= max_bytes or quality <= 40:
+                return output.getbuffer(), 'image/jpeg', img.width, img.height
+            quality -= 15
+
+
+class DescriptionCache:
+    # Two tier cache of vision model image descriptions: an in-memory LRU in front of
+    # an image_descriptions table in chat.db, so descriptions survive restarts
+
+    def __init__(self, chatdb_file: str, max_size: int = 1024):
+        self.connection = sqlite3.connect(chatdb_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS image_descriptions (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL
+                )
+            ''')
+        self.max_size = max_size
+        self.entries : OrderedDict = OrderedDict()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def remember(self, key: str, description: str, size: int):
+        self.entries[key] = (description, size)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+        else:
+            with self.lock:
+                entry = self.connection.execute('SELECT description, size FROM image_descriptions WHERE key = ?', (key,)).fetchone()
+            if entry is None:
+                self.misses += 1
+                return None
+            self.remember(key, *entry)
+            self.db_hits += 1
+        self.bytes_saved += entry[1]
+        return entry[0]
+
+    def put(self, key: str, description: str, size: int):
+        self.remember(key, description, size)
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO image_descriptions (key, description, size, created) VALUES (?, ?, ?, ?)',
+                    (key, description, size, time.time())
+                )
+        except sqlite3.OperationalError as e:
+            # The memory tier still has it, it's only lost on restart
+            logging.warning(f'Failed to store image description {key}: {e}')
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            'size': len(self.entries),
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'hit_rate': (self.memory_hits + self.db_hits) / lookups if lookups > 0 else 0.0
+        }